@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import click
+
+
+def _to_mb(peak_rss_mb):
+    # peak memory is not reported where resource is not available
+    return float('nan') if peak_rss_mb is None else peak_rss_mb
+
+
+def _run_in_subprocess(*args):
+    # every measurement gets a fresh interpreter, so peak RSS of one run does not leak into another
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__)] + [str(arg) for arg in args])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name='run-action', hidden=True)
+@click.argument('action', type=click.Choice(choices=('upload', 'download')))
+@click.argument('sav_file_path', type=click.Path(exists=True))
+@click.argument('xlsx_file_path', type=click.Path())
+@click.option('--metadata-only/--with-data', default=True)
+@click.option('--write-only/--in-memory', default=True)
+@click.option('--multiple-choice-separator', default='@', type=str)
+def run_action(action, sav_file_path, xlsx_file_path, metadata_only, write_only, multiple_choice_separator):
+    from profiling import get_peak_memory_mb
+    from template import create_template
+
+    t1 = time.time()
+    template = create_template(sav_file_path=sav_file_path,
+                               multiple_choice_separator=multiple_choice_separator,
+                               template_file_path=xlsx_file_path,
+                               metadata_only=metadata_only)
+    if action == 'download':
+        template.download_template(write_only=write_only)
+    else:
+        template.upload_template()
+
+    print(json.dumps({'wall_time': time.time() - t1, 'peak_rss_mb': get_peak_memory_mb()}))
+
+
+@cli.command(name='download-upload')
+@click.argument('sav_file_path', type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', default='@', type=str)
+def download_upload(sav_file_path, multiple_choice_separator):
+    """Wall time and peak RSS of download and upload with and without case data"""
+
+    xlsx_file_path = os.path.join(tempfile.mkdtemp(), 'template.xlsx')
+    for mode in ('--with-data', '--metadata-only'):
+        for action in ('download', 'upload'):
+            result = _run_in_subprocess('run-action', action, sav_file_path, xlsx_file_path, mode,
+                                        '--multiple-choice-separator', multiple_choice_separator)
+            print('{0:<16}{1:<10}{2:>10.2f} s{3:>12.1f} MB'.format(
+                mode.lstrip('-'), action, result['wall_time'], _to_mb(result['peak_rss_mb'])))
+
+
+@cli.command(name='download-writers')
+@click.argument('sav_file_path', type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', default='@', type=str)
+def download_writers(sav_file_path, multiple_choice_separator):
+    """Wall time and peak RSS of download with in-memory and write-only workbooks"""
+
+    xlsx_file_path = os.path.join(tempfile.mkdtemp(), 'template.xlsx')
+    for mode in ('--in-memory', '--write-only'):
+        result = _run_in_subprocess('run-action', 'download', sav_file_path, xlsx_file_path, mode,
+                                    '--multiple-choice-separator', multiple_choice_separator)
+        print('{0:<16}{1:>10.2f} s{2:>12.1f} MB'.format(mode.lstrip('-'), result['wall_time'],
+                                                        _to_mb(result['peak_rss_mb'])))
+
+
+@cli.command(name='render')
+@click.option('--tables-count', '-n', default=20000, type=int)
+@click.option('--properties', default='m', type=str, help='Properties of every table')
+def render(tables_count, properties):
+    """Tables per second of spss syntax rendering"""
+    from models import Table, TableStatistics
+    from structs import VariableStructure
+
+    variable_values = OrderedDict((float(value), 'label %d' % value) for value in list(range(1, 11)) + [99])
+    tables = []
+    for idx in range(tables_count):
+        table = Table(question_structure=VariableStructure(variable_id='q%d' % idx, variable_type=0,
+                                                           variable_values=variable_values))
+        table.id = 'q%d' % idx
+        table.title = 'Title %d' % idx
+        table.subtitle = 'Question %d' % idx
+        table.footer = 'Base: all respondents'
+        table.corner = ''
+        table.rows = ['q%d@%d' % (idx, child) for child in range(5)]
+        table.statistics = TableStatistics()
+        table.statistics.add_properties(properties)
+        tables.append(table)
+
+    t1 = time.time()
+    for table in tables:
+        table.to_syntax('spss')
+    wall_time = time.time() - t1
+    print('{0} tables for {1:.3f} s, {2:.0f} tables per second'.format(tables_count, wall_time, tables_count / wall_time))
+
+
+@cli.command(name='structure')
+@click.option('--variables-count', '-n', multiple=True, type=int, default=(20000, 100000))
+def structure(variables_count):
+    """Lookup costs of SurveyStructure on synthetic variables"""
+    from structs import SurveyStructure
+
+    for count in variables_count:
+        variables_ids = ['q%d@%d' % (idx // 10, idx % 10) for idx in range(count)]
+        timings = OrderedDict()
+
+        t1 = time.time()
+        survey_structure = SurveyStructure(multiple_choice_separator='@')
+        for variable_id in variables_ids:
+            survey_structure.add_variable(variable_id=variable_id, variable_type=0, variable_values={1: 'yes'})
+        timings['add_variable'] = time.time() - t1
+
+        t1 = time.time()
+        for variable_id in variables_ids:
+            survey_structure.get_variable_by_id(variable_id)
+        timings['get_variable_by_id'] = time.time() - t1
+
+        t1 = time.time()
+        for variable_id in variables_ids:
+            variable_id in survey_structure
+        timings['contains'] = time.time() - t1
+
+        t1 = time.time()
+        for variable_id in variables_ids[-1000:]:
+            survey_structure.remove(variable_id)
+        timings['remove (last 1000)'] = time.time() - t1
+
+        for stage, wall_time in timings.items():
+            print('{0:>8}  {1:<20}{2:>10.3f} s'.format(count, stage, wall_time))
+
+
+@cli.command(name='memory')
+@click.option('--variables-count', '-n', default=50000, type=int)
+@click.option('--grid-size', default=10, type=int)
+def memory(variables_count, grid_size):
+    """Memory used by plain and compact SurveyStructure on a synthetic dictionary"""
+    import tracemalloc
+    from structs import SurveyStructure, CompactSurveyStructure
+
+    values_labels = OrderedDict((float(value), 'label %d' % value) for value in range(1, 11))
+    for struct_class in (SurveyStructure, CompactSurveyStructure):
+        tracemalloc.start()
+        survey_structure = struct_class(multiple_choice_separator='@')
+        for idx in range(variables_count):
+            survey_structure.add_variable(variable_id='q%d@%d' % (idx // grid_size, idx % grid_size),
+                                          variable_type=0,
+                                          variable_label='question %d' % (idx // grid_size),
+                                          variable_values=OrderedDict(values_labels))
+        used_memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{0:<24}{1:>10.1f} MB'.format(struct_class.__name__, used_memory / 1024 / 1024))
+        del survey_structure
+
+
+def generate_sav_file(sav_file_path, variables_count, cases_count, grids_count=0, grid_rows=5,
+                      values_count=5, multiple_choice_separator='@', seed=0):
+    """Writes a synthetic sav file. Grid batteries are g<i>_<row>@<option> variables, the rest are
+        single q<i> variables, all of them numeric with values_count labeled values"""
+    from savReaderWriter import SavWriter
+
+    variables_names = []
+    variables_labels = {}
+    for grid_idx in range(grids_count):
+        for row in range(1, grid_rows + 1):
+            for option in range(1, values_count + 1):
+                variable_name = 'g%d_%d%s%d' % (grid_idx, row, multiple_choice_separator, option)
+                variables_names.append(variable_name)
+                variables_labels[variable_name] = 'Grid %d row %d' % (grid_idx, row)
+    for variable_idx in range(max(variables_count - len(variables_names), 0)):
+        variable_name = 'q%d' % variable_idx
+        variables_names.append(variable_name)
+        variables_labels[variable_name] = 'Question %d' % variable_idx
+
+    values_labels = dict((float(value), 'Value %d' % value) for value in range(1, values_count + 1))
+    random_generator = random.Random(seed)
+    with SavWriter(sav_file_path, variables_names, dict((name, 0) for name in variables_names),
+                   valueLabels=dict((name, values_labels) for name in variables_names),
+                   varLabels=variables_labels, ioUtf8=True) as writer:
+        for _ in range(cases_count):
+            writer.writerow([random_generator.randint(1, values_count) for _ in variables_names])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_stages(sav_file_path, xlsx_file_path, multiple_choice_separator, properties):
+    from openpyxl import load_workbook
+    from parsers import SavFile
+    from template import TemplateMaker, render_tables_syntax
+
+    timings = OrderedDict()
+
+    t1 = time.time()
+    sav_file = SavFile(sav_file_name=sav_file_path, multiple_choice_separator=multiple_choice_separator,
+                       metadata_only=True, compact_struct=True)
+    timings['sav_file_load'] = time.time() - t1
+
+    t1 = time.time()
+    plain_struct = sav_file.get_plain_struct(False, multiple_choice_separator, compact_struct=True)
+    timings['get_plain_struct'] = time.time() - t1
+
+    t1 = time.time()
+    sav_file.data
+    timings['case_data_load'] = time.time() - t1
+
+    t1 = time.time()
+    plain_struct.convert_to_hierarchical_structure()
+    timings['convert_to_hierarchical_structure'] = time.time() - t1
+
+    t1 = time.time()
+    template = TemplateMaker(template_file_path=xlsx_file_path, survey_structure=sav_file.plain_struct)
+    timings['template_maker_init'] = time.time() - t1
+
+    t1 = time.time()
+    template.download_template()
+    timings['download_template'] = time.time() - t1
+
+    wb = load_workbook(filename=xlsx_file_path)
+    ws = wb['tables']
+    for row in range(2, ws.max_row + 1):
+        ws.cell(row=row, column=7).value = properties
+    wb.save(xlsx_file_path)
+
+    t1 = time.time()
+    template.upload_template(incremental=False)
+    timings['upload_template'] = time.time() - t1
+
+    wb = load_workbook(filename=xlsx_file_path, read_only=True)
+    tables = list(template._iter_tables(wb['tables'], template._copy_hierarchical_structure()))
+    wb.close()
+    t1 = time.time()
+    for _ in render_tables_syntax((table.id, None, None, table) for table in tables):
+        pass
+    timings['syntax_rendering'] = time.time() - t1
+
+    return timings
+
+
+@cli.command(name='suite')
+@click.option('--variables-count', default=2000, type=int)
+@click.option('--cases-count', default=10000, type=int)
+@click.option('--grids-count', default=50, type=int)
+@click.option('--grid-rows', default=5, type=int)
+@click.option('--values-count', default=5, type=int)
+@click.option('--properties', default='t2 b2 m', type=str, help='Properties of every table')
+@click.option('--repeat', default=3, type=int, help='The best of repeat runs is reported')
+@click.option('--output', help='json file with results, benchmark_<commit>.json by default', type=click.Path())
+def suite(variables_count, cases_count, grids_count, grid_rows, values_count, properties, repeat, output):
+    """Times every stage from sav file load to syntax rendering on a synthetic sav file"""
+    multiple_choice_separator = '@'
+    work_dir = tempfile.mkdtemp()
+    sav_file_path = os.path.join(work_dir, 'synthetic.sav')
+    generate_sav_file(sav_file_path, variables_count=variables_count, cases_count=cases_count,
+                      grids_count=grids_count, grid_rows=grid_rows, values_count=values_count,
+                      multiple_choice_separator=multiple_choice_separator)
+
+    timings = OrderedDict()
+    for _ in range(repeat):
+        for stage, wall_time in _time_stages(sav_file_path, os.path.join(work_dir, 'synthetic.xlsx'),
+                                             multiple_choice_separator, properties).items():
+            timings[stage] = min(timings.get(stage, wall_time), wall_time)
+
+    for stage, wall_time in timings.items():
+        print('{0:<36}{1:>10.3f} s'.format(stage, wall_time))
+
+    commit = _git_commit()
+    if not output:
+        output = 'benchmark_%s.json' % (commit or 'unknown', )
+    with open(output, 'w') as output_file:
+        json.dump(OrderedDict([
+            ('commit', commit),
+            ('python', sys.version.split()[0]),
+            ('parameters', OrderedDict([('variables_count', variables_count), ('cases_count', cases_count),
+                                        ('grids_count', grids_count), ('grid_rows', grid_rows),
+                                        ('values_count', values_count), ('properties', properties),
+                                        ('repeat', repeat)])),
+            ('stages', timings),
+        ]), output_file, indent=2)
+    print('results are saved to', output)
+
+
+def _varstocases(data, makes):
+    """Stacks data as spss VARSTOCASES with rot_idx: a row per case and index,
+        rows with all made variables missing are dropped"""
+    import numpy as np
+    import pandas as pd
+
+    cases_count = len(data)
+    items_count = len(next(iter(makes.values())))
+    stacked = pd.DataFrame(OrderedDict(
+        (make, np.concatenate([data[variable].to_numpy() for variable in variables]))
+        for make, variables in makes.items()
+    ))
+    stacked['rot_idx'] = np.repeat(np.arange(1, items_count + 1), cases_count)
+    return stacked.dropna(how='all', subset=list(makes))
+
+
+def _emulate_restructures(base_file_path, batches):
+    """Seconds of restructuring and tabulating every batch of batteries after reading the base file,
+        as getbase and VARSTOCASES do in spss"""
+    import pandas as pd
+
+    t1 = time.time()
+    for batch in batches:
+        data = pd.read_pickle(base_file_path)
+        makes = OrderedDict((make, variables) for battery in batch for make, variables in battery.items())
+        stacked = _varstocases(data, makes)
+        for battery in batch:
+            battery_makes = list(battery)
+            # cases of the battery, as if it were restructured alone
+            battery_cases = stacked[stacked[battery_makes].notnull().any(axis=1)]
+            battery_cases.groupby('rot_idx')[battery_makes].count()
+    return time.time() - t1
+
+
+@cli.command(name='restructure')
+@click.option('--cases-count', default=20000, type=int)
+@click.option('--grids-count', default=50, type=int)
+@click.option('--grid-rows', default=5, type=int)
+@click.option('--values-count', default=5, type=int, help='multiple choice options of a grid row')
+@click.option('--batch-size', default=10, type=int, help='grids restructured at once in the batched mode')
+def restructure(cases_count, grids_count, grid_rows, values_count, batch_size):
+    """VARSTOCASES passes and data reloads of the generated syntax with one restructure per grid and batched,
+        and their cost emulated with pandas on synthetic case data, every grid is asked to 70% of cases"""
+    import numpy as np
+    import pandas as pd
+    from openpyxl import load_workbook
+    from structs import SurveyStructure
+    from template import TemplateMaker
+
+    work_dir = tempfile.mkdtemp()
+    survey_structure = SurveyStructure(multiple_choice_separator='@')
+    variable_values = OrderedDict((float(value), 'Value %d' % value) for value in range(1, values_count + 1))
+    for grid_idx in range(grids_count):
+        for row in range(1, grid_rows + 1):
+            for option in range(1, values_count + 1):
+                survey_structure.add_variable('g%d_%d@%d' % (grid_idx, row, option), 0,
+                                              'Grid %d row %d' % (grid_idx, row), variable_values=variable_values)
+    survey_structure.add_variable('q_0', 0, 'Question', variable_values=variable_values)
+
+    # questions are grouped into grids only when some of them are treated as independent
+    xlsx_file_path = os.path.join(work_dir, 'synthetic.xlsx')
+    template = TemplateMaker(template_file_path=xlsx_file_path, survey_structure=survey_structure,
+                             treat_as_independent_vars=['q_0'])
+    template.download_template()
+    syntax_counts = OrderedDict()
+    for mode, restructure_batch_size in (('per grid', None), ('batched', batch_size)):
+        template.upload_template(incremental=False, restructure_batch_size=restructure_batch_size)
+        with io.open(os.path.join(work_dir, 'synthetic_lin.sps'), encoding='utf-8') as syntax_file:
+            syntax = syntax_file.read()
+        syntax_counts[mode] = (syntax.count('VARSTOCASES\n'), syntax.count('\ngetbase.\n'))
+
+    random_generator = np.random.RandomState(0)
+    data = OrderedDict()
+    batteries = []
+    for grid_idx in range(grids_count):
+        is_asked = random_generator.rand(cases_count) < 0.7
+        battery = OrderedDict()
+        for option in range(1, values_count + 1):
+            variables = ['g%d_%d@%d' % (grid_idx, row, option) for row in range(1, grid_rows + 1)]
+            for variable in variables:
+                values = random_generator.randint(1, values_count + 1, cases_count).astype(float)
+                values[~is_asked] = np.nan
+                data[variable] = values
+            battery[variables[0]] = variables
+        batteries.append(battery)
+    base_file_path = os.path.join(work_dir, 'base.pkl')
+    pd.DataFrame(data).to_pickle(base_file_path)
+
+    emulated = OrderedDict([
+        ('per grid', _emulate_restructures(base_file_path, [[battery] for battery in batteries])),
+        ('batched', _emulate_restructures(base_file_path, [batteries[batch_start:batch_start + batch_size]
+                                                           for batch_start in range(0, grids_count, batch_size)])),
+    ])
+
+    print('{0:<12}{1:>14}{2:>10}{3:>14}'.format('mode', 'VARSTOCASES', 'getbase', 'emulated'))
+    for mode, (restructures_count, reloads_count) in syntax_counts.items():
+        print('{0:<12}{1:>14}{2:>10}{3:>12.3f} s'.format(mode, restructures_count, reloads_count, emulated[mode]))
+
+
+# modules the command line must not import before a command needs them
+HEAVY_MODULES = ('openpyxl', 'pandas', 'numpy', 'savReaderWriter')
+COLD_START_BUDGET = 0.5
+
+
+def _get_import_times(module_name):
+    """(nesting level, module, cumulative seconds) of every import of module_name by -X importtime"""
+    output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+                                     stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+    import_times = []
+    for line in output.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, imported = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # nested imports are indented by two spaces a level
+        level = (len(imported) - len(imported.lstrip()) - 1) // 2
+        import_times.append((level, imported.strip(), int(cumulative) / 1000000))
+    return import_times
+
+
+def _time_cold_start(script_name):
+    t1 = time.time()
+    subprocess.check_output([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), script_name),
+                             '--help'])
+    return time.time() - t1
+
+
+@cli.command(name='imports')
+@click.option('--module', 'modules', help='command line module', multiple=True, default=('template', 'service'),
+              show_default=True)
+@click.option('--budget', help='seconds of <module>.py --help in a fresh interpreter', default=COLD_START_BUDGET,
+              show_default=True, type=float)
+@click.option('--top', help='number of the slowest imports shown', default=10, type=int)
+def imports(modules, budget, top):
+    """Import times of the command line modules, fails over the budget or if a heavy module is imported at start"""
+    if sys.version_info < (3, 7):
+        print('-X importtime needs python 3.7 or newer')
+        sys.exit(1)
+
+    failed = False
+    for module_name in modules:
+        import_times = _get_import_times(module_name)
+        heavy_modules = sorted(set(imported.split('.')[0] for _, imported, _ in import_times
+                                   if imported.split('.')[0] in HEAVY_MODULES))
+        cold_start = _time_cold_start(module_name + '.py')
+        module_time = sum(seconds for level, imported, seconds in import_times
+                          if level == 0 and imported == module_name)
+
+        print('{0}: import {1:.3f} s, {0}.py --help {2:.3f} s, budget {3:.3f} s'.format(
+            module_name, module_time, cold_start, budget))
+        for level, imported, seconds in sorted(import_times, key=lambda import_time: -import_time[2])[:top]:
+            print('{0:>10.3f} s  {1}{2}'.format(seconds, '  ' * level, imported))
+        if heavy_modules:
+            print('heavy modules imported at start: ' + ', '.join(heavy_modules))
+        failed = failed or cold_start > budget or bool(heavy_modules)
+
+    if failed:
+        sys.exit(1)
+
+
+@cli.command(name='compare')
+@click.argument('baseline', type=click.Path(exists=True, readable=True, file_okay=True))
+@click.argument('current', type=click.Path(exists=True, readable=True, file_okay=True))
+def compare(baseline, current):
+    """Stage timings of two suite results"""
+    with open(baseline) as baseline_file:
+        baseline_results = json.load(baseline_file, object_pairs_hook=OrderedDict)
+    with open(current) as current_file:
+        current_results = json.load(current_file, object_pairs_hook=OrderedDict)
+    if baseline_results['parameters'] != current_results['parameters']:
+        print('warning: results were made with different parameters')
+
+    print('{0:<36}{1:>12}{2:>12}'.format('stage', str(baseline_results['commit']), str(current_results['commit'])))
+    for stage, current_time in current_results['stages'].items():
+        baseline_time = baseline_results['stages'].get(stage)
+        if baseline_time is None:
+            print('{0:<36}{1:>12}{2:>10.3f} s'.format(stage, '-', current_time))
+            continue
+        change = (current_time - baseline_time) / baseline_time * 100 if baseline_time else 0
+        print('{0:<36}{1:>10.3f} s{2:>10.3f} s{3:>+9.1f}%'.format(stage, baseline_time, current_time, change))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from profiling import profiler, profiled
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'tbltemplate2spss')
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+METADATA_FILE_NAME = 'metadata.json'
+
+
+class SavCacheEntry(object):
+    """Decoded sav file: metadata and one memory-mapped .npy file per variable.
+        numpy and pandas are imported on use, so the cache costs nothing to import"""
+
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+        with io.open(os.path.join(entry_dir, METADATA_FILE_NAME), mode='r', encoding='utf-8') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.cases_count = metadata['cases_count']
+        self.variable_names = metadata['variable_names']
+        self.variable_labels = metadata['variable_labels']
+        self.variable_types = metadata['variable_types']
+        # json keys are strings, so values labels are kept as [value, label] pairs
+        self.value_labels = dict(
+            (variable_name, dict((value, label) for value, label in value_labels))
+            for variable_name, value_labels in metadata['value_labels'].items()
+        )
+        self._columns = {}
+
+    def get_column(self, variable_name):
+        if variable_name not in self._columns:
+            import numpy as np
+
+            column_file_name = '%d.npy' % self.variable_names.index(variable_name)
+            self._columns[variable_name] = np.load(os.path.join(self.entry_dir, column_file_name), mmap_mode='r')
+        return self._columns[variable_name]
+
+    def get_cases(self, chunk_start=0, chunk_end=None, variables=None):
+        import pandas as pd
+
+        return pd.DataFrame(dict(
+            (variable_name, self.get_column(variable_name)[chunk_start:chunk_end])
+            for variable_name in variables or self.variable_names
+        ), columns=list(variables or self.variable_names))
+
+    @classmethod
+    def write(cls, entry_dir, sav_file):
+        """Decodes the sav file chunk by chunk into entry_dir"""
+        import numpy as np
+
+        variable_names = list(sav_file._get_variable_names())
+        cases_count = 0
+        columns = None
+        for chunk in sav_file.iter_cases(as_dataframe=False):
+            if columns is None:
+                total_cases_count = sav_file._get_np_reader().shape.nrows
+                columns = [
+                    np.lib.format.open_memmap(os.path.join(entry_dir, '%d.npy' % variable_idx), mode='w+',
+                                              dtype=chunk.dtype[variable_idx], shape=(total_cases_count, ))
+                    for variable_idx in range(len(variable_names))
+                ]
+            for variable_idx, variable_name in enumerate(chunk.dtype.names):
+                columns[variable_idx][cases_count:cases_count + len(chunk)] = chunk[variable_name]
+            cases_count += len(chunk)
+        for column in columns or []:
+            column.flush()
+
+        metadata = {
+            'cases_count': cases_count,
+            'variable_names': variable_names,
+            'variable_labels': dict(sav_file._get_variable_labels()),
+            'variable_types': dict(sav_file._get_variable_types()),
+            'value_labels': dict(
+                (variable_name, list(value_labels.items()))
+                for variable_name, value_labels in sav_file._get_value_labels().items()
+            ),
+        }
+        with io.open(os.path.join(entry_dir, METADATA_FILE_NAME), mode='w', encoding='utf-8') as metadata_file:
+            metadata_file.write(json.dumps(metadata, ensure_ascii=False))
+
+
+class SavCache(object):
+    """Directory of decoded sav files keyed by path, size, mtime and content hash of the sav file.
+        Least recently used entries are removed when the directory grows over max_size bytes"""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def get_key(sav_file_path, file_hash):
+        """Key of the sav file entry, file_hash is parsers.get_file_hash of the file computed by the caller"""
+        sav_file_path = os.path.abspath(sav_file_path)
+        stat = os.stat(sav_file_path)
+        key = '\0'.join([sav_file_path, str(stat.st_size), repr(stat.st_mtime), file_hash])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.exists(os.path.join(entry_dir, METADATA_FILE_NAME)):
+            profiler.count('sav_cache_misses')
+            return None
+        # mtime of the entry directory is its last use
+        os.utime(entry_dir, None)
+        profiler.count('sav_cache_hits')
+        return SavCacheEntry(entry_dir)
+
+    @profiled('sav_cache_write')
+    def put(self, key, sav_file):
+        entry_dir = os.path.join(self.cache_dir, key)
+        # entries are written aside and renamed, so a broken write never looks like a valid entry
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp')
+        try:
+            SavCacheEntry.write(temp_dir, sav_file)
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(temp_dir, entry_dir)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        self.evict(keep=entry_dir)
+        return SavCacheEntry(entry_dir)
+
+    def _get_entries(self):
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            if entry_name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            entry_size = sum(os.path.getsize(os.path.join(entry_dir, file_name))
+                             for file_name in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(entry_dir), entry_size, entry_dir))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """Removes least recently used entries until the cache fits max_size"""
+        entries = self._get_entries()
+        cache_size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, entry_dir in entries:
+            if cache_size <= self.max_size:
+                break
+            if entry_dir == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            cache_size -= entry_size
+            profiler.count('sav_cache_evictions')
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import csv
+import io
+from collections import OrderedDict
+
+import numpy as np
+from openpyxl.workbook import Workbook
+
+from models import BANNER_VARIABLE
+from parsers import CASES_CHUNK_SIZE
+from profiling import profiler, profiled
+
+TOTAL_COLUMN = 'Total'
+BASE_ROW = 'BASE'
+
+
+def _add_counts(counts, categories, banner):
+    """Adds counts of categories by banner values and in total (None key) to counts[category][banner value].
+        Missing categories are not counted, cases with missing banner value are counted in total only"""
+    has_category = ~np.isnan(categories)
+    categories, banner = categories[has_category], banner[has_category]
+
+    distinct_categories, categories_counts = np.unique(categories, return_counts=True)
+    for category, count in zip(distinct_categories.tolist(), categories_counts.tolist()):
+        category_counts = counts.setdefault(category, {})
+        category_counts[None] = category_counts.get(None, 0) + count
+
+    has_banner = ~np.isnan(banner)
+    if not has_banner.any():
+        return
+    pairs, pairs_counts = np.unique(np.column_stack([categories[has_banner], banner[has_banner]]),
+                                    axis=0, return_counts=True)
+    for (category, banner_value), count in zip(pairs.tolist(), pairs_counts.tolist()):
+        category_counts = counts[category]
+        category_counts[banner_value] = category_counts.get(banner_value, 0) + count
+
+
+def _add_moments(moments, values, banner):
+    """Adds cases count, sum and sum of squares of values by banner values and in total to moments"""
+    has_value = ~np.isnan(values)
+    values, banner = values[has_value], banner[has_value]
+    if not len(values):
+        return
+
+    total = moments.setdefault(None, [0, 0.0, 0.0])
+    total[0] += len(values)
+    total[1] += values.sum()
+    total[2] += (values ** 2).sum()
+
+    has_banner = ~np.isnan(banner)
+    banner_values, banner_idxs = np.unique(banner[has_banner], return_inverse=True)
+    values = values[has_banner]
+    banner_moments = [
+        np.bincount(banner_idxs, minlength=len(banner_values)),
+        np.bincount(banner_idxs, weights=values, minlength=len(banner_values)),
+        np.bincount(banner_idxs, weights=values ** 2, minlength=len(banner_values)),
+    ]
+    for banner_idx, banner_value in enumerate(banner_values.tolist()):
+        banner_total = moments.setdefault(banner_value, [0, 0.0, 0.0])
+        for moment_idx, moment in enumerate(banner_moments):
+            banner_total[moment_idx] += moment[banner_idx].item()
+
+
+class TableResult(object):
+    """Numbers of one table: rows of (label, statistic, values by column) under the columns labels"""
+
+    def __init__(self, table, columns):
+        self.table = table
+        self.columns = columns
+        self.rows = []
+
+
+class _TableCounter(object):
+    """Accumulates counts and moments of one table chunk by chunk, the way spss computes its syntax:
+        - rows variables are a group of categories, a case is counted once per distinct value;
+        - top and bottom boxes count cases with any value in the box;
+        - column percentages are taken of cases with any value;
+        - with mean, cases missing any row variable are left out of the table
+          and mean and variance are taken of the first row variable without the 9/99 values;
+        - with drop_empty_cases, cases missing all row variables are left out of the table,
+          as VARSTOCASES drops them from the restructured file"""
+
+    def __init__(self, table, drop_empty_cases=False):
+        self.table = table
+        self.drop_empty_cases = drop_empty_cases
+        self.boxes = table.get_boxes()
+        self.mean_missing_values = table.get_mean_missing_values() if table.statistics.mean else None
+        self.counts = {}
+        self.boxes_counts = {}
+        self.responders = {}
+        self.base = {}
+        self.moments = {}
+
+    def add_chunk(self, chunk, banner):
+        values = chunk[self.table.rows].to_numpy(dtype=float)
+        if self.mean_missing_values is not None:
+            # temp. sel if ~sysmis(rows)
+            has_values = ~np.isnan(values).any(axis=1)
+            values, banner = values[has_values], banner[has_values]
+        elif self.drop_empty_cases:
+            has_values = ~np.isnan(values).all(axis=1)
+            values, banner = values[has_values], banner[has_values]
+
+        _add_counts(self.base, np.zeros(len(values)), banner)
+
+        # a case is counted once per value, repeated values of a case are dropped after sorting
+        sorted_values = np.sort(values, axis=1)
+        is_counted = ~np.isnan(sorted_values)
+        is_counted[:, 1:] &= sorted_values[:, 1:] != sorted_values[:, :-1]
+        cases_idxs = np.nonzero(is_counted)[0]
+        _add_counts(self.counts, sorted_values[is_counted], banner[cases_idxs])
+
+        is_responder = is_counted.any(axis=1)
+        _add_counts(self.responders, np.zeros(is_responder.sum()), banner[is_responder])
+
+        for _, recode_value, _, recoded_values in self.boxes:
+            in_box = np.isin(values, recoded_values).any(axis=1)
+            _add_counts(self.boxes_counts, np.full(in_box.sum(), float(recode_value)), banner[in_box])
+
+        if self.mean_missing_values is not None:
+            mean_values = values[:, 0].copy()
+            mean_values[np.isin(mean_values, self.mean_missing_values)] = np.nan
+            _add_moments(self.moments, mean_values, banner)
+
+    def _get_categories(self):
+        # labeled values in the labels sheet order, then other values in the data
+        categories = OrderedDict()
+        for value, label in self.table.question_structure['variable_values'].items():
+            if value is None or label is None:
+                continue
+            try:
+                categories[float(value)] = label
+            except (TypeError, ValueError):
+                continue
+        for value in sorted(self.counts):
+            if value not in categories:
+                categories[value] = '%g' % value
+        return categories
+
+    def get_result(self, banner_keys, columns):
+        result = TableResult(self.table, columns)
+        responders = [self.responders.get(0.0, {}).get(key, 0) for key in banner_keys]
+
+        def add_category_rows(label, category_counts):
+            counts = [category_counts.get(key, 0) for key in banner_keys]
+            result.rows.append((label, 'count', counts))
+            result.rows.append((label, 'cpct', [
+                100.0 * count / responders_count if responders_count else None
+                for count, responders_count in zip(counts, responders)
+            ]))
+
+        for value, label in self._get_categories().items():
+            add_category_rows(label, self.counts.get(value, {}))
+        for _, recode_value, recode_label, _ in self.boxes:
+            add_category_rows(recode_label, self.boxes_counts.get(float(recode_value), {}))
+
+        if self.mean_missing_values is not None:
+            means, variances = [], []
+            for key in banner_keys:
+                cases_count, values_sum, squares_sum = self.moments.get(key, (0, 0.0, 0.0))
+                means.append(values_sum / cases_count if cases_count else None)
+                variances.append((squares_sum - values_sum ** 2 / cases_count) / (cases_count - 1)
+                                 if cases_count > 1 else None)
+            result.rows.append(('mean', 'mean', means))
+            result.rows.append(('variance', 'variance', variances))
+
+        result.rows.append((BASE_ROW, 'base', [self.base.get(0.0, {}).get(key, 0) for key in banner_keys]))
+        return result
+
+
+class TablesEngine(object):
+    """Computes template tables from case data of SavFile without spss.
+        Case data is read once by chunk_size cases, only variables of the tables and the banner are read.
+        Tables are broken down by values of banner_variable. Cases missing the banner value are left out,
+        as spss leaves them out of TABLES ... BY tban. The total column is an extra of the engine, the sum
+        of the banner columns; files without the banner variable have the total column only.
+        Tables of varstocases_tables_ids are computed one by one as the blocks of rot_idx in the spss table,
+        of cases with any row variable"""
+
+    def __init__(self, sav_file, banner_variable=BANNER_VARIABLE, chunk_size=CASES_CHUNK_SIZE):
+        self.sav_file = sav_file
+        self.banner_variable = banner_variable
+        self.chunk_size = chunk_size
+
+    def _is_computable(self, table, variable_types):
+        # string variables are not tabulated
+        for variable_id in table.rows:
+            if variable_types.get(variable_id) != 0:
+                profiler.count('tables_skipped')
+                return False
+        return True
+
+    def _get_columns(self, banner_values):
+        banner_labels = self.sav_file._get_value_labels().get(self.banner_variable, {})
+        return [TOTAL_COLUMN] + [banner_labels.get(banner_value, '%g' % banner_value)
+                                 for banner_value in banner_values]
+
+    @profiled('tables_compute')
+    def compute(self, tables, varstocases_tables_ids=()):
+        variable_types = self.sav_file._get_variable_types()
+        counters = [_TableCounter(table, drop_empty_cases=table.id in varstocases_tables_ids)
+                    for table in tables if self._is_computable(table, variable_types)]
+        profiler.count('tables_computed', len(counters))
+
+        variables = list(OrderedDict.fromkeys(
+            variable_id for counter in counters for variable_id in counter.table.rows
+        ))
+        has_banner = variable_types.get(self.banner_variable) == 0
+        if has_banner and self.banner_variable not in variables:
+            variables.append(self.banner_variable)
+
+        banner_values = set()
+        if variables:
+            for chunk in self.sav_file.iter_cases(chunk_size=self.chunk_size, variables=variables):
+                if has_banner:
+                    banner = chunk[self.banner_variable].to_numpy(dtype=float)
+                    has_banner_value = ~np.isnan(banner)
+                    chunk, banner = chunk[has_banner_value], banner[has_banner_value]
+                    banner_values.update(np.unique(banner).tolist())
+                else:
+                    banner = np.full(len(chunk), np.nan)
+                for counter in counters:
+                    counter.add_chunk(chunk, banner)
+
+        banner_values = sorted(banner_values)
+        banner_keys = [None] + banner_values
+        columns = self._get_columns(banner_values)
+        return [counter.get_result(banner_keys, columns) for counter in counters]
+
+
+def write_tables_csv(results, file_path):
+    """Writes every number of the tables on its own line: table id, row, statistic, column, value"""
+    with io.open(file_path, mode='w', encoding='utf-8', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['table_id', 'row', 'statistic', 'column', 'value'])
+        for result in results:
+            for label, statistic, values in result.rows:
+                for column, value in zip(result.columns, values):
+                    writer.writerow([result.table.id, label, statistic, column, '' if value is None else value])
+
+
+def write_tables_xlsx(results, file_path):
+    """Writes tables one under another as spss shows them: column percentages, mean, variance and base counts"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title='tables')
+    for result in results:
+        table = result.table
+        ws.append([(table.title or '').upper()])
+        ws.append([table.subtitle])
+        ws.append([table.corner] + result.columns)
+        for label, statistic, values in result.rows:
+            if statistic == 'count':
+                continue
+            # rounded as the spss formats of the statistics: PCT5.0, F5.2 and F5.0
+            precision = 2 if statistic in ('mean', 'variance') else 0
+            ws.append([label] + [None if value is None else round(value, precision) for value in values])
+        if table.footer:
+            ws.append([table.footer])
+        ws.append([])
+    wb.save(file_path)
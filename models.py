@@ -1,18 +1,48 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals
 
+from string import Formatter
+
+# banner variable of the generated syntax, tables are broken down by its values
+BANNER_VARIABLE = 'tban'
+
 
 class TablesSet(object):
+    """Tables in template order indexed by id"""
+
     def __init__(self):
         self.tables = []
         self.tables_ids = []
+        self.tables_idx = {}
 
     def add_table(self, table):
+        self.tables_idx.setdefault(table.id, len(self.tables))
         self.tables.append(table)
         self.tables_ids.append(table.id)
 
     def get_table_by_id(self, table_id):
-        return self.tables[self.tables_ids.index(table_id)]
+        try:
+            return self.tables[self.tables_idx[table_id]]
+        except KeyError:
+            raise ValueError('%s is not in list' % (table_id, ))
+
+
+def _compile_template(template):
+    """Splits a format template into literal text and field names once, so rendering is a single join"""
+    return [(literal_text, field_name) for literal_text, field_name, _, _ in Formatter().parse(template)]
+
+
+def _render_template(compiled_template, fields):
+    parts = []
+    for literal_text, field_name in compiled_template:
+        parts.append(literal_text)
+        if field_name is not None:
+            parts.append(fields[field_name])
+    return u''.join(parts)
+
+
+def _field_text(value):
+    return u'' if value is None else value
 
 
 class Table(object):
@@ -20,6 +50,11 @@ class Table(object):
     SPSS_TABLE_TEMPLATE = u'{ADDITIONAL}\nTABLES\n/FORMAT ZERO MISSING("."){OBS}\n/MRGROUP $ff "" {VARS}\n' \
                           u'/FTOTAL $T "BASE"\n/TABLE={TVARS} BY tban\n/STAT\n{STATS}\tcount ($T (F5.0) "" )\n' \
                           u'/TITLE "{TITLE}"\n"{SUBTITLE}"\n/CAPTION "{CAPTION}"\n/CORNER "{CORNER}".\n\n'
+    SPSS_CPCT_STATISTIC = u'\tcpct ($ff (PCT5.0) "" : sban)\n'
+    SPSS_MEAN_TEMPLATE = u'\tmean ({MEANVARIABLE} (F5.2) "mean")\n\tvariance ({MEANVARIABLE} (F5.2) "variance")\n'
+
+    _SPSS_TABLE_COMPILED = _compile_template(SPSS_TABLE_TEMPLATE)
+    _SPSS_MEAN_COMPILED = _compile_template(SPSS_MEAN_TEMPLATE)
 
     def __init__(self, question_structure):
         self.id = None
@@ -31,6 +66,8 @@ class Table(object):
         self.statistics = None
         self.footer = None
         self.chart = None
+        # spss condition selecting cases of the table, e.g. of one battery in a batched VARSTOCASES
+        self.case_filter = None
 
         self.question_structure = question_structure
 
@@ -40,94 +77,87 @@ class Table(object):
         if syntax_type == 'spss':
             return self._convert_to_spss_syntax()
 
+    def get_boxes(self):
+        """(property, recode value, label, recoded values) of every top and bottom box property"""
+        boxes = []
+        if self.statistics.percentage is None:
+            return boxes
+        for prop in self.statistics.percentage.props:
+            if prop.startswith('t') or prop.startswith('b'):
+                first_letter = prop[0]
+                letter_multiplier = 1 if first_letter == 't' else 2
+                try:
+                    num = int(prop[1:])
+                    # empty rows of the labels sheet add None to values
+                    label_values = sorted(v for v in self.question_structure['variable_values'].keys()
+                                          if v is not None)
+                except ValueError as e:
+                    print(prop, prop[1:])
+                    continue
+                except TypeError as e:
+                    print(prop, e)
+                    continue
+                recoded_values = label_values[-1*num:] if first_letter == 't' else label_values[:num]
+                recode_label = (u'Top-' if first_letter == 't' else u'Bottom-') + str(num)
+                boxes.append((prop, letter_multiplier*100+num, recode_label, recoded_values))
+        return boxes
+
+    def get_mean_missing_values(self):
+        """Values recoded to system missing before mean and variance: 9 and 99 unless 8 and 98 are labeled"""
+        label_values = self.question_structure['variable_values'].keys()
+        missing_values = []
+        if 9 in label_values and 8 not in label_values:
+            missing_values.append(9)
+        if 99 in label_values and 98 not in label_values:
+            missing_values.append(99)
+        return missing_values
+
     def _convert_to_spss_syntax(self):
-        spss_settings = {
-            'text_varstocases': '',
-            'text_recode': '',
-            'text_filter': '',
-            'spss_mrgroup_variables': '',
-            'spss_table_variables': '',
-            'spss_statistics': '',
-            'spss_obs': ''
-        }
-        text_recode = ''
-        text_filter = ''
-        text_statistics = ''
+        recodes = []
+        conditions = [self.case_filter] if self.case_filter else []
+        statistics = []
+        spss_obs = u''
         spss_mrgroup_variables = list(self.rows)
         spss_table_variables = [u'$ff']
         question_variable_id = self.question_structure['variable_id']
-
-        spss_cpct_template = u'\tcpct ($ff ({PCTFORMAT}) "{PCTSIGN}" : sban)\n'
-        spss_mean_template = u'\tmean ({MEANVARIABLE} ({MEANFORMAT}) "{MEANSIGN}")\n\tvariance ({MEANVARIABLE} (F5.2) "variance")\n'
+        rows_text = u' '.join(self.rows)
 
         if self.statistics.percentage is not None:
-            text_statistics += spss_cpct_template.format(PCTFORMAT=u'PCT5.0', PCTSIGN=u'')
-            for prop in self.statistics.percentage.props:
-                if prop.startswith('t') or prop.startswith('b'):
-                    first_letter = prop[0]
-                    letter_multiplier = 1 if first_letter == 't' else 2
-                    try:
-                        num = int(prop[1:])
-                        label_values = self.question_structure['variable_values'].keys()
-                        label_values.sort()
-
-                        text_recode += u'recode ' + ' '.join(self.rows)
-
-                        if first_letter == 't':
-                            text_recode += u' (' + u', '.join([str(v) for v in label_values[-1*num:]])
-                        else:
-                            text_recode += u' (' + u', '.join([str(v) for v in label_values[1:num+1]]) #starts with 1 because of None
-
-                        text_recode += u' = ' + str(letter_multiplier*100+num) + u')(else=sys) into '
-                        text_recode += prop + question_variable_id + u'.\n'
-                        text_recode += u'val lab ' + prop + question_variable_id
-                        text_recode += u' ' + str(letter_multiplier*100+num)
-                        text_recode += (u' "Top-' if first_letter == 't' else u' "Bottom-') + str(num) + u'".\n'
-                        spss_mrgroup_variables.append(prop + question_variable_id)
-                    except ValueError as e:
-                        print(prop, prop[1:])
-
-                    except TypeError as e:
-                        print(prop, e)
+            statistics.append(self.SPSS_CPCT_STATISTIC)
+            for prop, recode_value, recode_label, recoded_values in self.get_boxes():
+                recode_variable = prop + question_variable_id
+                recodes.append(u''.join([
+                    u'recode ', rows_text, u' (', u', '.join([str(v) for v in recoded_values]),
+                    u' = ', str(recode_value), u')(else=sys) into ', recode_variable, u'.\n',
+                    u'val lab ', recode_variable, u' ', str(recode_value), u' "', recode_label, u'".\n'
+                ]))
+                spss_mrgroup_variables.append(recode_variable)
         if self.statistics.mean:
-
-            label_values = self.question_structure['variable_values'].keys()
-            recode_to_sysmis = u''
-            if 9 in label_values and 8 not in label_values:
-                recode_to_sysmis += u'(9=sys)'
-            if 99 in label_values and 98 not in label_values:
-                recode_to_sysmis += u'(99=sys)'
-            text_recode += u'recode ' + u' '.join(self.rows) + u' ' + recode_to_sysmis + u'(else=copy) into '
-            text_recode += u'm' + question_variable_id + u'.\n'
-            text_filter = u'temp.\nsel if ~sysmis(' + u' '.join(self.rows) + u').\n'
+            recode_to_sysmis = u''.join(u'(%d=sys)' % value for value in self.get_mean_missing_values())
             mean_variable = u'm' + question_variable_id
-            spss_settings['spss_obs'] += u'\n/OBS ' + mean_variable
+            recodes.append(u''.join([
+                u'recode ', rows_text, u' ', recode_to_sysmis, u'(else=copy) into ', mean_variable, u'.\n'
+            ]))
+            conditions.append(u'~sysmis(' + rows_text + u')')
+            spss_obs = u'\n/OBS ' + mean_variable
             spss_table_variables.append(mean_variable)
-            text_statistics += spss_mean_template.format(MEANVARIABLE=mean_variable, MEANFORMAT=u'F5.2', MEANSIGN=u'mean')
-
-        spss_settings['text_recode'] = text_recode
-        spss_settings['text_filter'] = text_filter
-
-        spss_settings['spss_mrgroup_variables'] = u' '.join(spss_mrgroup_variables)
-        spss_settings['spss_statistics'] = text_statistics
+            statistics.append(_render_template(self._SPSS_MEAN_COMPILED, {'MEANVARIABLE': mean_variable}))
 
         spss_table_variables.append(u'$T')
-        spss_settings['spss_table_variables'] = u'+'.join(spss_table_variables)
-
-        return self.SPSS_TABLE_TEMPLATE.format(
-            ADDITIONAL=text_recode+text_filter,
-            OBS=spss_settings['spss_obs'],
-            VARS=spss_settings['spss_mrgroup_variables'],
-            TVARS=spss_settings['spss_table_variables'],
-            STATS=spss_settings['spss_statistics'],
-            TITLE=self.title.upper(),
-            SUBTITLE=self.subtitle,
-            CORNER=self.corner,
-            CAPTION=self.footer
-        ).replace(u'None', u'')
-
-
-
+        text_filter = u'temp.\nsel if ' + u' and '.join(conditions) + u'.\n' if conditions else u''
+
+        # missing fields are rendered as empty strings
+        return _render_template(self._SPSS_TABLE_COMPILED, {
+            'ADDITIONAL': u''.join(recodes) + text_filter,
+            'OBS': spss_obs,
+            'VARS': u' '.join(spss_mrgroup_variables),
+            'TVARS': u'+'.join(spss_table_variables),
+            'STATS': u''.join(statistics),
+            'TITLE': _field_text(self.title).upper(),
+            'SUBTITLE': _field_text(self.subtitle),
+            'CORNER': _field_text(self.corner),
+            'CAPTION': _field_text(self.footer)
+        })
 
 
 class TableRows(object):
@@ -1,51 +1,333 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals
 
-from savReaderWriter.savReader import SavReader
 from collections import OrderedDict
+from itertools import islice
+import hashlib
+import sys
 
-from structs import SurveyStructure, VariableStructure
-import pandas as pd
+from profiling import profiler, profiled
+from structs import SurveyStructure, CompactSurveyStructure, VariableStructure
+
+# savReaderWriter, numpy and pandas are imported by the methods using them,
+# so metadata of templates and file hashes do not pay for them
 
 DUMMY_FIELDS = ['InterviewID', 'Respondent', 'PanelResp', 'Page', 'Start', 'End', "ValidateCount",
                 'Status', 'QueryString', 'Referer', 'IP', 'Agent', 'Length', 'Version',
                 'SurveyStarted', 'ValidateCount@1', 'pre_data@resp', 'pre_data@s', 'pre_data@a']
 
+# unlabeled variables with more distinct values than this are considered open-ended
+MAX_UNLABELED_VALUES = 1000
+
+HASH_CHUNK_SIZE = 1024 * 1024
+CASES_CHUNK_SIZE = 10000
+# values counted at once by get_value_frequencies, chunks are sized by cells as files may have 50k variables
+FREQUENCIES_CHUNK_CELLS = 10 ** 7
+# spss system missing value of numeric variables
+SYSMIS_CUTOFF = -sys.float_info.max
+
+
+@profiled('sav_file_hash')
+def get_file_hash(file_path):
+    """sha1 of the file content"""
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _recode_sysmis(cases):
+    """Recodes system missing values of numeric fields to nan in place.
+        The numpy reader recodes them in whole arrays, but not in slices"""
+    import numpy as np
+
+    for field_name in cases.dtype.names or [None]:
+        field = cases if field_name is None else cases[field_name]
+        if field.dtype.kind == 'f':
+            field[field <= SYSMIS_CUTOFF] = np.nan
+
+
+def _strip_strings(cases):
+    """Strips in place the spaces string fields are padded with, as SavReader does"""
+    import numpy as np
+
+    for field_name in cases.dtype.names or []:
+        if cases.dtype[field_name].kind == 'S':
+            cases[field_name] = np.char.rstrip(cases[field_name])
+
+
+def _sum_runs(columns, values, counts=None):
+    """Sums counts over runs of equal (column, value) pairs of sorted pairs, without counts every pair counts 1"""
+    import numpy as np
+
+    if not len(columns):
+        return columns, values, np.zeros(0, dtype=np.int64)
+    is_first = np.empty(len(columns), dtype=bool)
+    is_first[0] = True
+    is_first[1:] = (columns[1:] != columns[:-1]) | (values[1:] != values[:-1])
+    first_idxs = np.flatnonzero(is_first)
+    if counts is None:
+        counts = np.diff(np.append(first_idxs, len(columns)))
+    else:
+        counts = np.add.reduceat(counts, first_idxs)
+    return columns[first_idxs], values[first_idxs], counts
+
 
 class SavFile(object):
 
-    def __init__(self, sav_file_name, use_unlabeled_values=False, multiple_choice_separator='_'):
+    def __init__(self, sav_file_name, use_unlabeled_values=False, multiple_choice_separator='_',
+                 metadata_only=False, max_unlabeled_values=MAX_UNLABELED_VALUES, compact_struct=False,
+                 cache=None, file_hash=None):
+        """With metadata_only=True case data is not read on init, `data` is materialized on first access.
+            With compact_struct=True plain_struct is a read-only CompactSurveyStructure.
+            With a cache.SavCache the file is decoded once into the cache, later metadata and case data are
+            read from its memory-mapped columns.
+            file_hash is get_file_hash of the file if the caller has it already"""
 
         self.sav_file_name = sav_file_name
-        self.reader = SavReader(self.sav_file_name, ioUtf8=True)
+        self._file_hash = file_hash
+        self._reader = None
+        self._data = None
+        self._np_reader = None
+        self._memmap_cases = {}
+
+        self._cache_entry = None
+        if cache is not None:
+            cache_key = cache.get_key(sav_file_name, self.file_hash)
+            self._cache_entry = cache.get(cache_key) or cache.put(cache_key, self)
+
+        self.plain_struct = self.get_plain_struct(use_unlabeled_values, multiple_choice_separator,
+                                                  max_unlabeled_values, compact_struct)
+        if not metadata_only:
+            self._data = self._read_data()
+
+    @property
+    def file_hash(self):
+        # the content is hashed once, by the cache key or the template structure snapshot
+        if self._file_hash is None:
+            self._file_hash = get_file_hash(self.sav_file_name)
+        return self._file_hash
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            from savReaderWriter.savReader import SavReader
+
+            with profiler.stage('sav_file_open'):
+                self._reader = SavReader(self.sav_file_name, ioUtf8=True)
+            self._reader.ioUtf8 = True
+        return self._reader
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._read_data()
+        return self._data
+
+    @profiled('case_data_load')
+    def _read_data(self):
+        import pandas as pd
+
+        if self._cache_entry is not None:
+            data = self._cache_entry.get_cases()
+            # string columns are cached as bytes, the reader returns them decoded and stripped of padding,
+            # entries written before chunks were stripped keep the padding
+            for variable_name in data.columns:
+                column = data[variable_name]
+                if column.dtype.kind == 'O' and len(column) and isinstance(column.iloc[0], bytes):
+                    data[variable_name] = column.str.decode('utf-8').str.rstrip()
+        else:
+            data = pd.DataFrame(self.reader.all(), columns=self.reader.varNames)
+        profiler.count('cases', len(data))
+        return data
+
+    def _get_np_reader(self):
+        if self._np_reader is None:
+            from savReaderWriter.savReaderNp import SavReaderNp
+
+            class UntitledSavReaderNp(SavReaderNp):
+                # dtypes of the reader take variable labels as field titles, but numpy refuses repeated titles
+                # and children of a multiple choice question share its label
+                _titles = property(lambda reader: [None] * len(reader.varNames))
+
+            self._np_reader = UntitledSavReaderNp(self.sav_file_name, ioUtf8=True)
+        return self._np_reader
+
+    def _rewind_np_reader(self):
+        # records of the numpy reader are read from the current case, the previous iteration may have moved it
+        np_reader = self._get_np_reader()
+        np_reader.seekNextCase(np_reader.fh, 0)
+        return np_reader
 
-        self.reader.ioUtf8 = True
-        self.plain_struct = self.get_plain_struct(use_unlabeled_values, multiple_choice_separator)
-        self.data = pd.DataFrame(self.reader.all(), columns=self.reader.varNames)
+    def _get_memmap_cases(self, memmap_file_name):
+        # the sav file is decoded to the memory-mapped file once per SavFile
+        if memmap_file_name not in self._memmap_cases:
+            with profiler.stage('case_data_memmap'):
+                self._memmap_cases[memmap_file_name] = self._rewind_np_reader().to_structured_array(memmap_file_name)
+        return self._memmap_cases[memmap_file_name]
+
+    def iter_cases(self, chunk_size=CASES_CHUNK_SIZE, variables=None, as_dataframe=True, memmap_file_name=None):
+        """Yields case data by chunk_size cases as DataFrames or numpy structured arrays.
+            With memmap_file_name cases are decoded once to a memory-mapped file by savReaderWriter numpy reader
+            and chunks are views of it, otherwise every chunk is read from the sav file.
+            Either way only one chunk is kept in memory. Chunks of cached files are read from the cache"""
+        import numpy as np
+        import pandas as pd
+
+        if self._cache_entry is not None:
+            for chunk_start in range(0, self._cache_entry.cases_count, chunk_size):
+                chunk = self._cache_entry.get_cases(chunk_start, chunk_start + chunk_size, variables)
+                profiler.count('cases_chunks')
+                yield chunk if as_dataframe else chunk.to_records(index=False)
+            return
+
+        np_reader = self._get_np_reader()
+        cases = self._get_memmap_cases(memmap_file_name) if memmap_file_name else np_reader
+        cases_count = np_reader.shape.nrows
+        # slices of the numpy reader fail for all-numeric files, their records are read in order instead
+        records = iter(self._rewind_np_reader()) if not memmap_file_name and np_reader.is_homogeneous else None
+
+        for chunk_start in range(0, cases_count, chunk_size):
+            if records is not None:
+                chunk = np.fromiter(islice(records, chunk_size), np_reader.trunc_dtype)
+            else:
+                chunk = cases[chunk_start:chunk_start + chunk_size]
+            if not memmap_file_name:
+                _recode_sysmis(chunk)
+            _strip_strings(chunk)
+            if variables:
+                chunk = chunk[list(variables)]
+            profiler.count('cases_chunks')
+            yield pd.DataFrame.from_records(chunk) if as_dataframe else chunk
 
     def _get_variable_names(self):
+        if self._cache_entry is not None:
+            return self._cache_entry.variable_names
         #copy all values into memory or the process will run slowly
         return self.reader.varNames
 
     def _get_variable_labels(self):
+        if self._cache_entry is not None:
+            return self._cache_entry.variable_labels
         return self.reader.varLabels
 
     def _get_variable_types(self):
+        if self._cache_entry is not None:
+            return self._cache_entry.variable_types
         return self.reader.varTypes
 
     def _get_value_labels(self):
+        if self._cache_entry is not None:
+            return self._cache_entry.value_labels
         return self.reader.valueLabels
 
-    def get_plain_struct(self, use_unlabeled_values, multiple_choice_separator):
-        db_struct = SurveyStructure(multiple_choice_separator=multiple_choice_separator)
+    @profiled('value_frequencies')
+    def get_value_frequencies(self, max_distinct_values=MAX_UNLABELED_VALUES, chunk_cells=FREQUENCIES_CHUNK_CELLS):
+        """Counts of every value of numeric variables in one pass over case data by chunks.
+            All columns of a chunk are sorted at once and counted by runs of equal values,
+            so there is no loop per variable. Variables with more than max_distinct_values distinct values
+            are treated as open-ended and left out of the result"""
+        import numpy as np
+
+        variable_types = self._get_variable_types()
+        variables = [variable_id for variable_id in self._get_variable_names() if variable_types.get(variable_id) == 0]
+        if not variables:
+            return OrderedDict()
+
+        is_counted = np.ones(len(variables), dtype=bool)
+        columns = np.zeros(0, dtype=np.intp)
+        values = np.zeros(0)
+        counts = np.zeros(0, dtype=np.int64)
+        chunk_size = max(1, chunk_cells // len(variables))
+        for chunk in self.iter_cases(chunk_size=chunk_size, variables=variables):
+            counted_idxs = np.flatnonzero(is_counted)
+            # a row per variable, so every variable is a contiguous sorted run of values
+            chunk_values = np.sort(chunk.to_numpy(dtype=float).T[counted_idxs], axis=1)
+            chunk_columns = np.repeat(counted_idxs, chunk_values.shape[1])
+            chunk_values = chunk_values.ravel()
+            has_value = ~np.isnan(chunk_values)
+            chunk_columns, chunk_values, chunk_counts = _sum_runs(chunk_columns[has_value], chunk_values[has_value])
+
+            columns = np.concatenate([columns, chunk_columns])
+            values = np.concatenate([values, chunk_values])
+            counts = np.concatenate([counts, chunk_counts])
+            order = np.lexsort((values, columns))
+            columns, values, counts = _sum_runs(columns[order], values[order], counts[order])
+
+            if max_distinct_values is not None:
+                is_counted &= np.bincount(columns, minlength=len(variables)) <= max_distinct_values
+                is_kept = is_counted[columns]
+                columns, values, counts = columns[is_kept], values[is_kept], counts[is_kept]
+
+        frequencies = OrderedDict((variables[variable_idx], OrderedDict())
+                                  for variable_idx in np.flatnonzero(is_counted).tolist())
+        for variable_idx, value, count in zip(columns.tolist(), values.tolist(), counts.tolist()):
+            frequencies[variables[variable_idx]][value] = count
+        return frequencies
+
+    @profiled('unlabeled_values_scan')
+    def _get_unlabeled_values(self, variables_ids, max_unlabeled_values=None):
+        """Collects distinct values of all variables_ids in a single pass over the records.
+            Variables with more than max_unlabeled_values distinct values are treated as open-ended
+            and left out of the result"""
+        if not variables_ids:
+            return OrderedDict()
+
+        if self._cache_entry is not None:
+            import numpy as np
+
+            unlabeled_values = OrderedDict()
+            for variable_id in variables_ids:
+                # system missing values are nan in the cache and None in records, strings are kept as bytes
+                values = set(None if value != value else value.decode('utf-8') if isinstance(value, bytes) else value
+                             for value in np.unique(self._cache_entry.get_column(variable_id)).tolist())
+                if max_unlabeled_values is None or len(values) <= max_unlabeled_values:
+                    unlabeled_values[variable_id] = values
+            return unlabeled_values
+
+        variables_idxs = {variable_id: idx for idx, variable_id in enumerate(self._get_variable_names())}
+        columns = [(variables_idxs[variable_id], set()) for variable_id in variables_ids]
+        for record in self.reader:
+            for column_idx, (variable_idx, values) in enumerate(columns):
+                if values is None:
+                    continue
+                values.add(record[variable_idx])
+                if max_unlabeled_values is not None and len(values) > max_unlabeled_values:
+                    columns[column_idx] = (variable_idx, None)
+
+        return OrderedDict(
+            (variable_id, values) for variable_id, (_, values) in zip(variables_ids, columns) if values is not None
+        )
+
+    @profiled('get_plain_struct')
+    def get_plain_struct(self, use_unlabeled_values, multiple_choice_separator,
+                         max_unlabeled_values=MAX_UNLABELED_VALUES, compact_struct=False):
+        struct_class = CompactSurveyStructure if compact_struct else SurveyStructure
+        db_struct = struct_class(multiple_choice_separator=multiple_choice_separator)
 
         variable_names = self._get_variable_names()
         variable_labels = self._get_variable_labels()
         variable_types = self._get_variable_types()
         variable_values = self._get_value_labels()
 
+        skipped_variables_ids = set()
+        unlabeled_variables_ids = []
+        if use_unlabeled_values:
+            for variable_id in variable_names:
+                if len(variable_values.get(variable_id, {})):
+                    continue
+                # in case values labels are empty
+                if variable_id in DUMMY_FIELDS or int(variable_types.get(variable_id, '')) > 1:
+                    # dummy fields and not int variables
+                    skipped_variables_ids.add(variable_id)
+                else:
+                    unlabeled_variables_ids.append(variable_id)
+        unlabeled_values = self._get_unlabeled_values(unlabeled_variables_ids, max_unlabeled_values)
+
         for variable_id in variable_names:
-            print(variable_id)
+            if variable_id in skipped_variables_ids:
+                continue
             variable_structure = VariableStructure(
                 variable_id=variable_id,
                 variable_label=variable_labels.get(variable_id, ''),
@@ -53,18 +335,12 @@ class SavFile(object):
                 variable_children=[],
                 variable_values=variable_values.get(variable_id, {})
             )
-            if not len(variable_structure['variable_values'].keys()) and use_unlabeled_values:
-                # in case values labels are empty
-                if variable_id in DUMMY_FIELDS:
-                    continue
-
-                if int(variable_structure['variable_type']) > 1:
-                    # not int variables
-                    continue
-
+            if variable_id in unlabeled_values:
+                # system missing values are None, they are not values of the variable and do not sort on python 3
                 variable_structure['variable_values'] = OrderedDict(
-                    (k, '') for k in sorted(set(self.reader[:, variable_names.index(variable_id)]))
+                    (k, '') for k in sorted(value for value in unlabeled_values[variable_id] if value is not None)
                 )
             db_struct.append(variable_structure)
 
-        return db_struct
\ No newline at end of file
+        profiler.count('variables', len(db_struct))
+        return db_struct
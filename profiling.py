@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import json
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak memory is not reported there
+    resource = None
+
+
+def get_peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return peak_rss / 1024
+
+
+class Profiler(object):
+    """Wall time, calls and peak memory of named stages plus counters of processed items.
+        Stages and counters are recorded only while the profiler is enabled"""
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    def reset(self):
+        self.stages = OrderedDict()
+        self.counts = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, OrderedDict([('wall_time', 0.0), ('calls', 0)]))
+            stage['wall_time'] += time.time() - t1
+            stage['calls'] += 1
+            stage['peak_memory_mb'] = get_peak_memory_mb()
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def report(self):
+        return OrderedDict([
+            ('stages', self.stages),
+            ('counts', self.counts),
+            ('peak_memory_mb', get_peak_memory_mb()),
+        ])
+
+    def save(self, report_file_path):
+        with open(report_file_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+profiler = Profiler()
+
+
+def profiled(name):
+    """Records every call of the decorated function as the stage name"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import json
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import HTTPError, Request, URLError, urlopen
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+import click
+
+# the client imports nothing else, template and its dependencies are imported by the server only
+SERVICE_HOST = '127.0.0.1'
+# the service has no authentication and writes files wherever a client asks, so it is not reachable from other hosts
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost')
+SERVICE_PORT = 8765
+MAX_TEMPLATE_MAKERS = 16
+# types of request fields, all but sav_file_path may be null
+REQUEST_FIELDS_TYPES = OrderedDict([
+    ('sav_file_path', string_types),
+    ('xlsx_file_path', string_types),
+    ('multiple_choice_separator', string_types),
+    ('processes', int),
+    ('compress', bool),
+])
+
+
+class TemplateMakersCache(object):
+    """TemplateMaker instances of the least recently handled max_size sav files.
+        A sav file is fingerprinted by path, size and mtime, so a changed file is parsed again"""
+
+    def __init__(self, max_size=MAX_TEMPLATE_MAKERS):
+        self.max_size = max_size
+        self.template_makers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(sav_file_path, multiple_choice_separator):
+        sav_file_path = os.path.abspath(sav_file_path)
+        stat = os.stat(sav_file_path)
+        return sav_file_path, stat.st_size, stat.st_mtime, multiple_choice_separator
+
+    def get(self, sav_file_path, multiple_choice_separator, template_file_path):
+        """Cached TemplateMaker of the sav file and whether it was cached"""
+        key = self.get_key(sav_file_path, multiple_choice_separator)
+        template_maker = self.template_makers.pop(key, None)
+        is_cached = template_maker is not None
+        if is_cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+            from template import create_template
+            template_maker = create_template(sav_file_path=sav_file_path,
+                                             multiple_choice_separator=multiple_choice_separator,
+                                             template_file_path=template_file_path)
+        # the most recently used maker goes last, the least recently used ones are evicted first
+        self.template_makers[key] = template_maker
+        while len(self.template_makers) > self.max_size:
+            self.template_makers.popitem(last=False)
+        return template_maker, is_cached
+
+    def status(self):
+        return OrderedDict([
+            ('entries', len(self.template_makers)),
+            ('max_size', self.max_size),
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('sav_files', [key[0] for key in self.template_makers]),
+        ])
+
+
+def validate_request(request):
+    """Raises ValueError if the request is not a json object of REQUEST_FIELDS_TYPES or the sav file is missing"""
+    if not isinstance(request, dict):
+        raise ValueError('request is not a json object')
+    for field, field_type in REQUEST_FIELDS_TYPES.items():
+        value = request.get(field)
+        if value is None and field != 'sav_file_path':
+            continue
+        # bool is an int too
+        if not isinstance(value, field_type) or field_type is int and isinstance(value, bool):
+            raise ValueError('{0} is not of type {1}'.format(field, field_type.__name__))
+    if not os.path.exists(request['sav_file_path']):
+        raise ValueError('sav file does not exist: ' + request['sav_file_path'])
+
+
+def handle_download(template_makers, request):
+    sav_file_path = request['sav_file_path']
+    template_file_path = request.get('xlsx_file_path') or sav_file_path + '.xlsx'
+    template_maker, is_cached = template_makers.get(sav_file_path, request.get('multiple_choice_separator') or '@',
+                                                    template_file_path)
+    template_maker.download_template(path=template_file_path)
+    return OrderedDict([('path', template_file_path), ('cached', is_cached)])
+
+
+def handle_upload(template_makers, request):
+    sav_file_path = request['sav_file_path']
+    template_file_path = request.get('xlsx_file_path') or sav_file_path + '.xlsx'
+    template_maker, is_cached = template_makers.get(sav_file_path, request.get('multiple_choice_separator') or '@',
+                                                    template_file_path)
+    template_maker.upload_template(path=template_file_path, processes=request.get('processes'),
+                                   compress=request.get('compress', False))
+    return OrderedDict([('path', template_file_path), ('cached', is_cached)])
+
+
+HANDLERS = {
+    '/download': handle_download,
+    '/upload': handle_upload,
+}
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """JSON requests of the client, requests are handled one at a time"""
+
+    def _send_json(self, code, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        self._send_json(200, self.server.template_makers.status())
+
+    def do_POST(self):
+        handler = HANDLERS.get(self.path)
+        if handler is None:
+            self._send_json(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            validate_request(request)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        t1 = time.time()
+        try:
+            response = handler(self.server.template_makers, request)
+        except Exception:
+            self._send_json(500, {'error': traceback.format_exc()})
+            return
+        response['elapsed'] = time.time() - t1
+        self._send_json(200, response)
+
+
+def serve(host=SERVICE_HOST, port=SERVICE_PORT, max_size=MAX_TEMPLATE_MAKERS):
+    if host not in LOOPBACK_HOSTS:
+        raise ValueError('the service has no authentication, it only listens on ' + ', '.join(LOOPBACK_HOSTS))
+
+    # heavy imports are paid once at start, not by the first request
+    import openpyxl
+    import pandas
+    import savReaderWriter
+    import template
+
+    server = HTTPServer((host, port), ServiceRequestHandler)
+    server.template_makers = TemplateMakersCache(max_size=max_size)
+    print('serving on {0}:{1}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def call_service(path, request=None, host=SERVICE_HOST, port=SERVICE_PORT):
+    """Response of the service, POST with the request or GET without it"""
+    url = 'http://{0}:{1}{2}'.format(host, port, path)
+    data = None if request is None else json.dumps(request).encode('utf-8')
+    try:
+        response = urlopen(Request(url, data=data, headers={'Content-Type': 'application/json'}))
+    except HTTPError as e:
+        response = e
+    return response.getcode(), json.loads(response.read().decode('utf-8'))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name='serve')
+@click.option('--host', default=SERVICE_HOST, show_default=True, type=click.Choice(choices=LOOPBACK_HOSTS))
+@click.option('--port', default=SERVICE_PORT, show_default=True, type=int)
+@click.option('--max-size', help='number of sav files kept parsed', default=MAX_TEMPLATE_MAKERS, show_default=True,
+              type=int)
+def serve_command(host, port, max_size):
+    """Keeps parsed sav files and serves download and upload requests of the client"""
+    serve(host=host, port=port, max_size=max_size)
+
+
+@cli.command(name='client')
+@click.argument('action', type=click.Choice(choices=('download', 'upload', 'status')))
+@click.argument('sav_file_path', required=False, type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', help='multiple choice separator', default='@', type=str)
+@click.option('--xlsx-file-path', help='excel template file path', type=click.Path(writable=True, file_okay=True))
+@click.option('--processes', help='number of worker processes rendering tables', type=int)
+@click.option('--compress', help='gzip spss files', is_flag=True)
+@click.option('--host', default=SERVICE_HOST, show_default=True)
+@click.option('--port', default=SERVICE_PORT, show_default=True, type=int)
+def client_command(action, sav_file_path, multiple_choice_separator, xlsx_file_path, processes, compress, host, port):
+    """Sends download or upload of the sav file to the running service"""
+    if action == 'status':
+        request = None
+    elif sav_file_path is None:
+        print('please specify sav file path')
+        sys.exit(1)
+    else:
+        # the service may run in another working directory
+        request = {
+            'sav_file_path': os.path.abspath(sav_file_path),
+            'xlsx_file_path': os.path.abspath(xlsx_file_path) if xlsx_file_path else None,
+            'multiple_choice_separator': multiple_choice_separator,
+            'processes': processes,
+            'compress': compress,
+        }
+
+    try:
+        code, response = call_service('/' + action, request, host=host, port=port)
+    except URLError as e:
+        print('service is not running on {0}:{1}: {2}'.format(host, port, e.reason))
+        sys.exit(1)
+
+    if code != 200:
+        print(response['error'])
+        sys.exit(1)
+    if action == 'status':
+        print(json.dumps(response, indent=2))
+    else:
+        print('{0} done for {1:.3f} seconds{2}: {3}'.format(
+            action, response['elapsed'], ' (cached)' if response['cached'] else '', response['path']))
+
+
+if __name__ == '__main__':
+    cli()
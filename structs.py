@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals
 
-from copy import deepcopy
+from array import array
 from collections import OrderedDict
 
+from profiling import profiler, profiled
+
 
 class SurveyStructure(list):
 
     def __init__(self, is_hierarchical=False, multiple_choice_separator='_', add_total=False):
 
         self._variables_ids_list = []
+        self._variables_ids_idx = {}
+        # bumped on every append/remove, invalidates memoized hierarchical structures
+        self._version = 0
+        self._hierarchical_cache = {}
         self.is_hierarchical = is_hierarchical
         self.multiple_choices_separator = multiple_choice_separator
 
@@ -24,7 +30,11 @@ class SurveyStructure(list):
             )
 
     def __contains__(self, key):
-        return key in self._variables_ids_list
+        return key in self._variables_ids_idx
+
+    def _reindex(self, start=0):
+        for variable_idx in range(start, len(self._variables_ids_list)):
+            self._variables_ids_idx[self._variables_ids_list[variable_idx]] = variable_idx
 
     def add_variable(self, variable_id, variable_type='', variable_label='',
                      variable_children=None, variable_survey_type='', variable_values=None):
@@ -38,13 +48,15 @@ class SurveyStructure(list):
             variable_values=variable_values
         )
 
-        if variable_id in self._variables_ids_list:
+        if variable_id in self._variables_ids_idx:
             self.remove(variable_id)
-        self._variables_ids_list.append(variable_id)
         self.append(variable_struct)
 
     def get_variable_by_id(self, variable_id):
-        return self[self._variables_ids_list.index(variable_id)]
+        try:
+            return self[self._variables_ids_idx[variable_id]]
+        except KeyError:
+            raise ValueError('%s is not in list' % (variable_id, ))
 
     def get_all_questions_ids(self):
         return self._variables_ids_list
@@ -56,15 +68,29 @@ class SurveyStructure(list):
         if isinstance(p_object, (dict, OrderedDict)):
             p_object = VariableStructure(**p_object)
 
-        if p_object['variable_id'] not in self._variables_ids_list:
+        if p_object['variable_id'] not in self._variables_ids_idx:
+            self._variables_ids_idx[p_object['variable_id']] = len(self._variables_ids_list)
             self._variables_ids_list.append(p_object['variable_id'])
 
-        super(SurveyStructure, self).append(p_object)
+        self._append_item(p_object)
+        self._version += 1
 
     def remove(self, variable_id):
-        variable_idx = self._variables_ids_list.index(variable_id)
-        self.pop(variable_idx)
+        try:
+            variable_idx = self._variables_ids_idx.pop(variable_id)
+        except KeyError:
+            raise ValueError('%s is not in list' % (variable_id, ))
+        self._pop_item(variable_idx)
         self._variables_ids_list.pop(variable_idx)
+        # positions after the removed variable are shifted by one
+        self._reindex(variable_idx)
+        self._version += 1
+
+    def _append_item(self, variable_structure):
+        super(SurveyStructure, self).append(variable_structure)
+
+    def _pop_item(self, variable_idx):
+        return self.pop(variable_idx)
 
     def to_dict(self):
         return {item['variable_id']: item for item in self}
@@ -81,52 +107,47 @@ class SurveyStructure(list):
                 raise TypeError('item type ' + str(type(item)) + ' is not instance of dict')
         return survey_structure
 
+    @profiled('convert_to_hierarchical_structure')
     def convert_to_hierarchical_structure(self, except_variables=None):
+        """Groups variables into questions by multiple choice separator.
+            The result is memoized until variables are appended or removed, so callers share it"""
         if self.is_hierarchical:
-            return deepcopy(self)
+            return self
         if except_variables and not isinstance(except_variables, (list, set)):
             raise Exception('except_variables must be iterable got instead %s' % (type(except_variables), ))
-        question_ids = []
-        for variable_id in self._variables_ids_list:
-            if except_variables:
-                if variable_id in except_variables:
-                    question_ids.append(variable_id)
-                else:
-                    question_ids.append(variable_id.split(self.multiple_choices_separator)[0])
-            else:
-                question_ids.append(variable_id.split(self.multiple_choices_separator)[0])
 
-        temp_structure = OrderedDict()
+        cache_key = (self.multiple_choices_separator, frozenset(except_variables) if except_variables else None)
+        cached_version, cached_structure = self._hierarchical_cache.get(cache_key, (None, None))
+        if cached_version == self._version:
+            return cached_structure
 
-        for variable_id_idx, question_id in enumerate(question_ids):
-            if question_id in temp_structure:
-                temp_structure[question_id].append(self._variables_ids_list[variable_id_idx])
+        questions_structures = OrderedDict()
+        for variable_id, variable_structure in zip(self._variables_ids_list, self):
+            if except_variables and variable_id in except_variables:
+                question_id = variable_id
             else:
-                temp_structure[question_id] = [self._variables_ids_list[variable_id_idx]]
-
-        new_survey_structure = SurveyStructure(is_hierarchical=True)
-        for question_id in temp_structure.keys():
-
-            variable_structure = self.get_variable_by_id(temp_structure[question_id][0])
-
-            question_structure = VariableStructure(
-                variable_id=question_id,
-                variable_type=variable_structure['variable_type'],
-                variable_label=variable_structure['variable_label'],
-                variable_children=deepcopy(variable_structure['variable_children']),
-                variable_survey_type=variable_structure['variable_survey_type'],
-                variable_values=deepcopy(variable_structure['variable_values'])
-            )
-
-            for variable_id in temp_structure[question_id]:
-                question_structure['variable_children'].append(variable_id)
-                question_structure['variable_values'].update(
-                    self.get_variable_by_id(variable_id)['variable_values']
+                question_id = variable_id.split(self.multiple_choices_separator)[0]
+
+            if question_id not in questions_structures:
+                # labels and values are immutable, so shallow copies are enough to keep the plain structure intact
+                questions_structures[question_id] = VariableStructure(
+                    variable_id=question_id,
+                    variable_type=variable_structure['variable_type'],
+                    variable_label=variable_structure['variable_label'],
+                    variable_children=list(variable_structure['variable_children']),
+                    variable_survey_type=variable_structure['variable_survey_type'],
+                    variable_values=OrderedDict()
                 )
+            question_structure = questions_structures[question_id]
+            question_structure['variable_children'].append(variable_id)
+            question_structure['variable_values'].update(variable_structure['variable_values'])
 
+        new_survey_structure = SurveyStructure(is_hierarchical=True)
+        for question_structure in questions_structures.values():
             new_survey_structure.append(question_structure)
-        new_survey_structure._variables_ids_list = list(temp_structure.keys())
 
+        profiler.count('questions', len(new_survey_structure))
+        self._hierarchical_cache[cache_key] = (self._version, new_survey_structure)
         return new_survey_structure
 
 
@@ -143,4 +164,182 @@ class VariableStructure(OrderedDict):
         self['variable_label'] = variable_label if variable_label else u''
         self['variable_children'] = variable_children if variable_children else []
         self['variable_survey_type'] = variable_survey_type if variable_survey_type else None
-        self['variable_values'] = variable_values if variable_values else OrderedDict()
\ No newline at end of file
+        self['variable_values'] = variable_values if variable_values else OrderedDict()
+
+    def __reduce__(self):
+        # OrderedDict pickling would call __init__ without arguments
+        return (self.__class__, (self['variable_id'], self['variable_type'], self['variable_label'],
+                                 self['variable_children'], self['variable_survey_type'], self['variable_values']))
+
+
+class _ReadOnlyMixin(object):
+    """OrderedDict refusing changes once frozen"""
+
+    _is_frozen = False
+
+    def freeze(self):
+        self._is_frozen = True
+        return self
+
+    def _check_changes(self):
+        if self._is_frozen:
+            raise TypeError('variables of CompactSurveyStructure are read-only, replace them by add_variable')
+
+    def __setitem__(self, key, value):
+        self._check_changes()
+        OrderedDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._check_changes()
+        OrderedDict.__delitem__(self, key)
+
+    def clear(self):
+        self._check_changes()
+        OrderedDict.clear(self)
+
+    def pop(self, *args):
+        self._check_changes()
+        return OrderedDict.pop(self, *args)
+
+    def popitem(self, *args, **kwargs):
+        self._check_changes()
+        return OrderedDict.popitem(self, *args, **kwargs)
+
+    def setdefault(self, *args):
+        self._check_changes()
+        return OrderedDict.setdefault(self, *args)
+
+
+class _ReadOnlyValues(_ReadOnlyMixin, OrderedDict):
+    pass
+
+
+class _ReadOnlyVariableStructure(_ReadOnlyMixin, VariableStructure):
+
+    def __reduce__(self):
+        # a copy is detached from the structure, so it is a plain VariableStructure
+        return (VariableStructure, (self['variable_id'], self['variable_type'], self['variable_label'],
+                                    list(self['variable_children']), self['variable_survey_type'],
+                                    OrderedDict(self['variable_values'])))
+
+
+class CompactSurveyStructure(SurveyStructure):
+    """SurveyStructure keeping variables metadata in columns instead of a dict per variable.
+        Items are built as read-only VariableStructure on access, as changes made to them would not be stored back.
+        Variables are changed by add_variable and remove"""
+
+    def __init__(self, is_hierarchical=False, multiple_choice_separator='_', add_total=False):
+        self._ids = []
+        self._types = _InternedColumn()
+        self._labels = _InternedColumn()
+        self._survey_types = _InternedColumn()
+        # value labels are kept as tuples of items, grid variables usually share the same ones
+        self._values = _InternedColumn()
+        # read-only value labels by code in _values, they are shared by the items built on access
+        self._values_items = {}
+        # children of the variable idx are _children[_children_offsets[idx]:_children_offsets[idx + 1]]
+        self._children = []
+        self._children_offsets = array(str('l'), [0])
+
+        super(CompactSurveyStructure, self).__init__(is_hierarchical=is_hierarchical,
+                                                     multiple_choice_separator=multiple_choice_separator,
+                                                     add_total=add_total)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        for variable_idx in range(len(self)):
+            yield self._get_item(variable_idx)
+
+    def __getitem__(self, variable_idx):
+        if isinstance(variable_idx, slice):
+            return [self._get_item(idx) for idx in range(*variable_idx.indices(len(self)))]
+        if variable_idx < 0:
+            variable_idx += len(self)
+        if not 0 <= variable_idx < len(self):
+            raise IndexError('list index out of range')
+        return self._get_item(variable_idx)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def _get_item(self, variable_idx):
+        variable_structure = _ReadOnlyVariableStructure(
+            variable_id=self._ids[variable_idx],
+            variable_type=self._types[variable_idx],
+            variable_label=self._labels[variable_idx],
+            variable_survey_type=self._survey_types[variable_idx],
+        )
+        variable_structure['variable_children'] = tuple(self._children[
+            self._children_offsets[variable_idx]:self._children_offsets[variable_idx + 1]
+        ])
+        variable_structure['variable_values'] = self._get_values_item(variable_idx)
+        return variable_structure.freeze()
+
+    def _get_values_item(self, variable_idx):
+        values_code = self._values.get_code(variable_idx)
+        values_item = self._values_items.get(values_code)
+        if values_item is None:
+            values_item = self._values_items[values_code] = _ReadOnlyValues(self._values[variable_idx]).freeze()
+        return values_item
+
+    def _append_item(self, variable_structure):
+        self._ids.append(variable_structure['variable_id'])
+        self._types.append(variable_structure['variable_type'])
+        self._labels.append(variable_structure['variable_label'])
+        self._survey_types.append(variable_structure['variable_survey_type'])
+        self._values.append(tuple(variable_structure['variable_values'].items()))
+        self._children.extend(variable_structure['variable_children'])
+        self._children_offsets.append(len(self._children))
+
+    def _pop_item(self, variable_idx):
+        variable_structure = self._get_item(variable_idx)
+
+        self._ids.pop(variable_idx)
+        self._types.pop(variable_idx)
+        self._labels.pop(variable_idx)
+        self._survey_types.pop(variable_idx)
+        self._values.pop(variable_idx)
+
+        children_start = self._children_offsets[variable_idx]
+        children_count = self._children_offsets[variable_idx + 1] - children_start
+        del self._children[children_start:children_start + children_count]
+        self._children_offsets.pop(variable_idx + 1)
+        for offset_idx in range(variable_idx + 1, len(self._children_offsets)):
+            self._children_offsets[offset_idx] -= children_count
+
+        return variable_structure
+
+    def pop(self, variable_idx=-1):
+        if variable_idx < 0:
+            variable_idx += len(self)
+        return self._pop_item(variable_idx)
+
+
+class _InternedColumn(object):
+    """Column of repeated hashable values stored as codes of distinct values"""
+
+    def __init__(self):
+        self._codes = array(str('l'))
+        self._distinct_values = []
+        self._distinct_values_codes = {}
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __getitem__(self, idx):
+        return self._distinct_values[self._codes[idx]]
+
+    def get_code(self, idx):
+        return self._codes[idx]
+
+    def append(self, value):
+        code = self._distinct_values_codes.get(value)
+        if code is None:
+            code = self._distinct_values_codes[value] = len(self._distinct_values)
+            self._distinct_values.append(value)
+        self._codes.append(code)
+
+    def pop(self, idx):
+        return self._distinct_values[self._codes.pop(idx)]
@@ -1,333 +1,934 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division, unicode_literals
 
-from openpyxl.workbook import Workbook
-from openpyxl import load_workbook
 import os
 from collections import OrderedDict
+from itertools import chain, islice
 import codecs
-import copy
-
-from models import *
+import cProfile
+import csv
+import glob
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import tempfile
+import traceback
+
+# openpyxl, pandas, numpy and savReaderWriter are imported on the code paths that use them,
+# so the command line starts without them
+from models import Table, TableStatistics, TablesSet, BANNER_VARIABLE
 from parsers import DUMMY_FIELDS
 
-from parsers import SavFile
+from cache import SavCache, DEFAULT_CACHE_DIR
+from parsers import SavFile, get_file_hash
+from profiling import profiler, profiled
+from structs import SurveyStructure, CompactSurveyStructure, VariableStructure
 import time
 import click
 
 VARSTOCASES_SPLIT = '_'
+# hidden sheet with the plain structure the template was made from
+STRUCTURE_SHEET = 'structure'
+# optional sheet with counts of values in case data
+FREQUENCIES_SHEET = 'frequencies'
+# tables rendered by a worker process at once
+TABLES_CHUNK_SIZE = 500
+SYNTAX_BUFFER_SIZE = 1024 * 1024
+# getbase reloads the data file after VARSTOCASES, in estimated cost it weighs as many tables
+GETBASE_COST = 20
+# batteries restructured by one VARSTOCASES in the batched mode
+RESTRUCTURE_BATCH_SIZE = 10
 
 
 class TemplateMaker(object):
 
-    def __init__(self, template_file_path, survey_structure, treat_as_independent_vars=None):
+    @profiled('template_maker_init')
+    def __init__(self, template_file_path, survey_structure, treat_as_independent_vars=None, sav_file_hash=None,
+                 value_frequencies=None):
         self.template_file_path = template_file_path
+        self.sav_file_hash = sav_file_hash
+        # counts of values by variable from SavFile.get_value_frequencies, written to the template if given
+        self.value_frequencies = value_frequencies
         self.plain_structure = survey_structure
         self.hierarchical_structure = self.plain_structure.convert_to_hierarchical_structure()
         self.independent_vars = treat_as_independent_vars
         self.varstocases_vars = self._find_varstocases_vars()
 
     def _find_varstocases_vars(self):
+        """Indexes of questions of every VARSTOCASES group with at least two questions.
+            The index is not changed by uploads, so the maker can be reused"""
         varstocases_vars = OrderedDict()
 
-        variables_ids = self.hierarchical_structure.get_all_questions_ids()
-        variables_ids_split = []
-        for variables_id in variables_ids:
-            if not self.independent_vars:
-                variables_ids_split.append(variables_id)
-                continue
-
-            if variables_id not in self.independent_vars:
-                variables_ids_split.append(variables_id.rsplit(VARSTOCASES_SPLIT, 1)[0])
-            else:
-                variables_ids_split.append(variables_id)
-
-        for variable_idx, variable_id_split in enumerate(variables_ids_split):
-            if variables_ids[variable_idx].find(VARSTOCASES_SPLIT) == -1:
+        for variable_idx, variables_id in enumerate(self.hierarchical_structure.get_all_questions_ids()):
+            if variables_id.find(VARSTOCASES_SPLIT) == -1:
                 continue
-            if variable_id_split in varstocases_vars:
-                varstocases_vars[variable_id_split].append(variable_idx)
+            if self.independent_vars and variables_id not in self.independent_vars:
+                variable_id_split = variables_id.rsplit(VARSTOCASES_SPLIT, 1)[0]
             else:
-                varstocases_vars[variable_id_split] = [variable_idx]
-
-        cp_varstocases_vars = copy.deepcopy(varstocases_vars)  # RuntimeError: OrderedDict mutated during iteration
-        for variable_id_split in cp_varstocases_vars:
-            if len(cp_varstocases_vars[variable_id_split]) < 2:
-                varstocases_vars.pop(variable_id_split, None)
-        return varstocases_vars
-
-    def download_template(self, path=None):
-        """This function parses variable and value labels and output template file to path in xlsx file.
-            Manager should fill xlsx file and upload it to server """
-
-        if not path:
-            path = self.template_file_path
-
-        wb = Workbook()
-        ws = wb.get_active_sheet()
+                variable_id_split = variables_id
+            varstocases_vars.setdefault(variable_id_split, []).append(variable_idx)
 
-        # filling tables
-        ws.title = 'tables'
-
-        for col, lb in enumerate(['QuestionID', 'Variables', 'Title', 'Subtitle\\Question', 'Caption', 'Corner', 'Properties']):
-            # making some headers on the list "table"
-            cell = ws.cell(row=1, column=col+1)
-            cell.value = lb
-
-
-        # do some nice-looking things with header
-        ws.column_dimensions['A'].width = 15
-        ws.column_dimensions['B'].width = 15
-        ws.column_dimensions['C'].width = 30
-        ws.column_dimensions['D'].width = 60
-        ws.column_dimensions['E'].width = 22
-        ws.column_dimensions['F'].width = 10
-        ws.column_dimensions['G'].width = 30
+        return OrderedDict(
+            (variable_id_split, tuple(variables_idxs))
+            for variable_id_split, variables_idxs in varstocases_vars.items() if len(variables_idxs) > 1
+        )
 
-        row = 2
+    def _copy_hierarchical_structure(self):
+        # uploads change labels and values of questions, every upload works on its own copy
+        hierarchical_structure = SurveyStructure(is_hierarchical=True)
+        for question_structure in self.hierarchical_structure:
+            hierarchical_structure.append(VariableStructure(
+                variable_id=question_structure['variable_id'],
+                variable_type=question_structure['variable_type'],
+                variable_label=question_structure['variable_label'],
+                variable_children=question_structure['variable_children'],
+                variable_survey_type=question_structure['variable_survey_type'],
+                variable_values=OrderedDict(question_structure['variable_values'])
+            ))
+        return hierarchical_structure
+
+    TABLES_HEADERS = ['QuestionID', 'Variables', 'Title', 'Subtitle\\Question', 'Caption', 'Corner', 'Properties']
+    TABLES_WIDTHS = [15, 15, 30, 60, 22, 10, 30]
+    LABELS_HEADERS = ['QuestionID', 'Variable', 'Value', 'Label']
+    LABELS_WIDTHS = [30, 30, 15, 100]
+    LABELS_COUNT_HEADER = 'Count'
+    LABELS_COUNT_WIDTH = 10
+    FREQUENCIES_HEADERS = ['Variable', 'Value', 'Label', 'Count']
+    FREQUENCIES_WIDTHS = [30, 15, 100, 10]
+
+    def _iter_tables_rows(self):
         for question_id in self.hierarchical_structure.get_all_questions_ids():
             # fill sheet by variable labels information
             if question_id in DUMMY_FIELDS:
                 continue
 
             question_structure = self.hierarchical_structure.get_variable_by_id(question_id)
-            ws.cell(row=row, column=1).value = question_id
-            ws.cell(row=row, column=2).value = ' '.join(question_structure['variable_children'])
-            ws.cell(row=row, column=4).value = question_structure['variable_label']
-            ws.cell(row=row, column=5).value = u'База: все респонденты'
-            row += 1
-
-        wb.create_sheet(title='labels')
-        ws = wb.get_sheet_by_name('labels')
-
-        for col, lb in enumerate(['QuestionID', 'Variable', 'Value', 'Label']):
-            cell = ws.cell(row=1, column=col+1)
-            cell.value = lb
-            # cell.fill.fill_type = FILL_SOLID
-            # cell.style.fill.start_color.index = 'FFD3D3D3'
-
-        ws.column_dimensions['A'].width = 30
-        ws.column_dimensions['B'].width = 30
-        ws.column_dimensions['C'].width = 15
-        ws.column_dimensions['D'].width = 100
-        row = 2
+            yield [question_id, ' '.join(question_structure['variable_children']), None,
+                   question_structure['variable_label'], u'База: все респонденты']
 
+    def _iter_labels_rows(self):
         for question_id in self.hierarchical_structure.get_all_questions_ids():
             if question_id in DUMMY_FIELDS:
                 continue
             question_structure = self.hierarchical_structure.get_variable_by_id(question_id)
-            ws.cell(row=row, column=1).value = question_id
-            ws.cell(row=row, column=2).value = ' '.join(question_structure['variable_children'])
+            question_row = [question_id, ' '.join(question_structure['variable_children'])]
+            if not len(question_structure['variable_values']):
+                yield question_row
+                continue
+            # question id goes with the first value, questions with values are separated by an empty row
             for (k, v) in question_structure['variable_values'].items():
-                ws.cell(row=row, column=3).value = k
-                ws.cell(row=row, column=4).value = v
-                row += 1
-            row += 1
-
-        wb.save(path)
+                if self.value_frequencies is None:
+                    yield question_row + [k, v]
+                else:
+                    # cases with the value summed over variables of the question
+                    yield question_row + [k, v, sum(self.value_frequencies.get(child, {}).get(k, 0)
+                                                    for child in question_structure['variable_children'])]
+                question_row = [None, None]
+            yield []
+
+    def _iter_frequencies_rows(self):
+        for question_id in self.hierarchical_structure.get_all_questions_ids():
+            if question_id in DUMMY_FIELDS:
+                continue
+            question_structure = self.hierarchical_structure.get_variable_by_id(question_id)
+            for child in question_structure['variable_children']:
+                for value, count in self.value_frequencies.get(child, {}).items():
+                    yield [child, value, question_structure['variable_values'].get(value), count]
+
+    def _iter_structure_rows(self):
+        yield ['sav_file_hash', self.sav_file_hash,
+               'multiple_choice_separator', self.plain_structure.multiple_choices_separator]
+        for variable_structure in self.plain_structure:
+            variable_row = [variable_structure['variable_id'], variable_structure['variable_type'],
+                            variable_structure['variable_label']]
+            if not len(variable_structure['variable_values']):
+                yield variable_row
+                continue
+            # values are dumped to json, excel would read 1.0 back as 1
+            for (k, v) in variable_structure['variable_values'].items():
+                yield variable_row + [json.dumps(k), v]
+                variable_row = [None, None, None]
+
+    @classmethod
+    @profiled('structure_snapshot_load')
+    def from_template(cls, template_file_path, sav_file_hash, multiple_choice_separator):
+        """Restores TemplateMaker from the structure saved by download_template without reading the sav file.
+            Returns None if the template has no structure or it was made from another sav file or separator"""
+        from openpyxl import load_workbook
+
+        wb = load_workbook(filename=template_file_path, read_only=True)
+        try:
+            if STRUCTURE_SHEET not in wb.sheetnames:
+                return None
+            rows = cls._iter_sheet_rows(wb[STRUCTURE_SHEET], 5, min_row=1)
+            header_row = next(rows, None)
+            # the sheet may have been emptied by hand
+            if header_row is None:
+                return None
+            _, snapshot_sav_file_hash, _, snapshot_separator, _ = header_row
+            if snapshot_sav_file_hash != sav_file_hash or snapshot_separator != multiple_choice_separator:
+                return None
+
+            survey_structure = CompactSurveyStructure(multiple_choice_separator=multiple_choice_separator)
+            variable_structure = None
+            for variable_id, variable_type, variable_label, value, value_label in rows:
+                if variable_id is not None:
+                    if variable_structure is not None:
+                        survey_structure.append(variable_structure)
+                    variable_structure = VariableStructure(variable_id=variable_id,
+                                                           variable_type=variable_type,
+                                                           variable_label=variable_label)
+                if value is not None:
+                    variable_structure['variable_values'][json.loads(value)] = value_label or ''
+            if variable_structure is not None:
+                survey_structure.append(variable_structure)
+        finally:
+            wb.close()
+
+        return cls(template_file_path=template_file_path, survey_structure=survey_structure,
+                   sav_file_hash=sav_file_hash)
+
+    @staticmethod
+    def _fill_sheet(ws, headers, widths, rows):
+        from openpyxl.utils import get_column_letter
+
+        # column widths must be set before any row is written in write-only mode
+        for col, width in enumerate(widths):
+            ws.column_dimensions[get_column_letter(col+1)].width = width
+
+        ws.append(headers)
+        rows_count = 0
+        for row in rows:
+            ws.append(row)
+            rows_count += 1
+        return rows_count
+
+    @staticmethod
+    def _iter_sheet_rows(ws, columns_count, min_row=2):
+        # read-only sheets skip trailing empty cells, so rows are padded to columns_count
+        for row in ws.iter_rows(min_row=min_row, max_col=columns_count, values_only=True):
+            yield tuple(row) + (None, ) * (columns_count - len(row))
+
+    @profiled('download_template')
+    def download_template(self, path=None, write_only=True):
+        """This function parses variable and value labels and output template file to path in xlsx file.
+            Manager should fill xlsx file and upload it to server.
+            With write_only=True rows are streamed to the file instead of being kept in memory"""
 
-    def upload_template(self, path=None):
         if not path:
             path = self.template_file_path
 
-        wb = load_workbook(filename=path)
-        ws = wb.get_sheet_by_name(name='tables')
-        row = 2
-        tables_set = TablesSet()
-        spss_syntax_file_path = os.path.splitext(path)[0] + "_lin.sps"
-        spss_syntax_file = codecs.open(spss_syntax_file_path, mode='w', encoding='utf-8', errors='replace')
+        from openpyxl.workbook import Workbook
+
+        wb = Workbook(write_only=write_only)
+        if write_only:
+            ws = wb.create_sheet(title='tables')
+        else:
+            ws = wb.active
+            ws.title = 'tables'
+        profiler.count('tables_rows', self._fill_sheet(ws, self.TABLES_HEADERS, self.TABLES_WIDTHS,
+                                                       self._iter_tables_rows()))
+
+        ws = wb.create_sheet(title='labels')
+        if self.value_frequencies is None:
+            labels_headers, labels_widths = self.LABELS_HEADERS, self.LABELS_WIDTHS
+        else:
+            labels_headers = self.LABELS_HEADERS + [self.LABELS_COUNT_HEADER]
+            labels_widths = self.LABELS_WIDTHS + [self.LABELS_COUNT_WIDTH]
+        profiler.count('labels_rows', self._fill_sheet(ws, labels_headers, labels_widths, self._iter_labels_rows()))
+
+        if self.value_frequencies is not None:
+            ws = wb.create_sheet(title=FREQUENCIES_SHEET)
+            profiler.count('frequencies_rows', self._fill_sheet(ws, self.FREQUENCIES_HEADERS, self.FREQUENCIES_WIDTHS,
+                                                                self._iter_frequencies_rows()))
+
+        if self.sav_file_hash:
+            ws = wb.create_sheet(title=STRUCTURE_SHEET)
+            ws.sheet_state = 'hidden'
+            for row in self._iter_structure_rows():
+                ws.append(row)
 
-        spss_lab_file_path = os.path.splitext(path)[0] + "_lab.sps"
-        spss_lab_file = codecs.open(spss_lab_file_path, mode='w', encoding='utf-8', errors='replace')
+        wb.save(path)
 
-        def _to_unicode(string):
-            if string is None:
-                return u''
-            if isinstance(string, str):
-                return string
-            return string.encode('uft-8')
+    @staticmethod
+    def _to_unicode(string):
+        if string is None:
+            return u''
+        if isinstance(string, str):
+            return string
+        return string.encode('uft-8')
 
-        while row <= ws.max_row:
+    def _read_labels_sheet(self, ws, hierarchical_structure):
+        previous_question_id = ''
+        for question_id, _, value, label in self._iter_sheet_rows(ws, len(self.LABELS_HEADERS)):
+            profiler.count('labels_rows')
+            if not question_id:
+                question_id = previous_question_id
+            if question_id:
+                question_structure = hierarchical_structure.get_variable_by_id(question_id)
+                question_structure['variable_values'].update({value: label})
+            previous_question_id = question_id
 
-            question_id = ws.cell(row=row, column=1).value
-            question_structure = self.hierarchical_structure.get_variable_by_id(question_id)
-            question_structure['variable_label'] = ws.cell(row=row, column=4).value
+    def _iter_tables(self, ws, hierarchical_structure):
+        for (question_id, variables, title, subtitle,
+             caption, corner, properties) in self._iter_sheet_rows(ws, len(self.TABLES_HEADERS)):
+            if question_id is None:
+                continue
+
+            question_structure = hierarchical_structure.get_variable_by_id(question_id)
+            question_structure['variable_label'] = subtitle
 
             table = Table(question_structure=question_structure)
             table.id = question_id
-            table.title = _to_unicode(ws.cell(row=row, column=3).value)
-            table.subtitle = _to_unicode(ws.cell(row=row, column=4).value)
-            table.footer = _to_unicode(ws.cell(row=row, column=5).value)
-            table.corner = _to_unicode(ws.cell(row=row, column=6).value)
-            table.rows = ws.cell(row=row, column=2).value.split(' ')
+            table.title = self._to_unicode(title)
+            table.subtitle = self._to_unicode(subtitle)
+            table.footer = self._to_unicode(caption)
+            table.corner = self._to_unicode(corner)
+            table.rows = variables.split(' ')
             table_statistics = TableStatistics()
-            table_statistics.add_properties(ws.cell(row=row, column=7).value)
+            table_statistics.add_properties(properties)
             table.statistics = table_statistics
 
-            tables_set.add_table(table)
-
-            row += 1
+            yield table
 
-        ws = wb.get_sheet_by_name(name='labels')
-        row = 2
-        previous_question_id = ''
-        while row <= ws.max_row:
-            question_id = ws.cell(row=row, column=1).value
-            if not question_id:
-                question_id = previous_question_id
-            if question_id:
-                question_structure = self.hierarchical_structure.get_variable_by_id(question_id)
-                question_structure['variable_values'].update(
-                    {ws.cell(row=row, column=3).value: ws.cell(row=row, column=4).value}
-                )
-            previous_question_id = question_id
-            row += 1
+    def _read_varstocases_tables(self, ws, hierarchical_structure):
+        # the first table of a VARSTOCASES group needs subtitles of the whole group, only those tables are kept
+        varstocases_ids = set(
+            hierarchical_structure[variable_idx]['variable_id']
+            for variables_idxs in self.varstocases_vars.values()
+            for variable_idx in variables_idxs
+        )
+        tables_set = TablesSet()
+        if varstocases_ids:
+            for table in self._iter_tables(ws, hierarchical_structure):
+                if table.id in varstocases_ids:
+                    tables_set.add_table(table)
+        return tables_set
+
+    def get_varstocases_tables_ids(self):
+        """Ids of tables restructured by VARSTOCASES in the syntax, tables of pre groups are not restructured"""
+        return set(
+            self.hierarchical_structure[variable_idx]['variable_id']
+            for split_id, variables_idxs in self.varstocases_vars.items() if not split_id.startswith('pre')
+            for variable_idx in variables_idxs
+        )
 
-        for table in tables_set.tables:
+    def _get_restructure_batches(self, batch_size):
+        """Batches of VARSTOCASES groups with the same number of questions by group id, up to batch_size a batch.
+            Groups of a batch are stacked by one VARSTOCASES sharing rot_idx"""
+        batches = OrderedDict()
+        for split_id, variables_idxs in self.varstocases_vars.items():
+            # tables of pre groups are not restructured
+            if not split_id.startswith('pre'):
+                batches.setdefault(len(variables_idxs), []).append(split_id)
+
+        restructure_batches = {}
+        for split_ids in batches.values():
+            for batch_start in range(0, len(split_ids), batch_size):
+                batch = tuple(split_ids[batch_start:batch_start + batch_size])
+                for split_id in batch:
+                    restructure_batches[split_id] = batch
+        return restructure_batches
+
+    def _iter_syntax_jobs(self, tables, hierarchical_structure, varstocases_tables_set, manifest,
+                          restructure_batches=None):
+        """Yields (table id, fingerprint, fragment, table) with table set only if its fragment is still to render.
+            With restructure_batches VARSTOCASES groups of a batch are rendered together at the first of them"""
+        # the first table of a VARSTOCASES group is rendered for the whole group, the rest are skipped
+        emitted_split_ids = set()
+        for table in tables:
+            profiler.count('tables')
             split_id = table.id.rsplit(VARSTOCASES_SPLIT, 1)[0]
             if split_id in self.varstocases_vars and not table.id.startswith('pre'):
-                if len(self.varstocases_vars[split_id]) > 1:
-                    spss_syntax_file.write(
-                        self._make_varstocases_syntax(
-                            variables_idxs=self.varstocases_vars[split_id],
-                            tables_set=tables_set
-                        )
-                    )
-                    table.rows = self.hierarchical_structure[self.varstocases_vars[split_id][0]]['variable_children']
-                    self.varstocases_vars[split_id] = []
-                    spss_syntax_file.write(table
-                                           .to_syntax('spss')
-                                           .replace(u'tban', u'rot_idx by tban')
-                                           .replace(u'sban', u'sban rot_idx')
+                batch = restructure_batches.get(split_id, ()) if restructure_batches else ()
+                if split_id not in emitted_split_ids and len(batch) > 1:
+                    emitted_split_ids.update(batch)
+                    batteries = [self._get_battery(batch_split_id, hierarchical_structure, varstocases_tables_set)
+                                 for batch_split_id in batch]
+                    fingerprint, fragment = manifest.lookup('lin', table.id, [
+                        'batch', [[self._get_table_inputs(battery_table), variables_lists, variables_titles]
+                                  for battery_table, variables_lists, variables_titles in batteries]
+                    ])
+                    if fragment is None:
+                        fragment = self._make_varstocases_batch_syntax(batteries)
+                    yield table.id, fingerprint, fragment, None
+                elif split_id not in emitted_split_ids:
+                    emitted_split_ids.add(split_id)
+                    _, variables_lists, variables_titles = self._get_battery(split_id, hierarchical_structure,
+                                                                             varstocases_tables_set)
+                    fingerprint, fragment = manifest.lookup(
+                        'lin', table.id, [self._get_table_inputs(table), variables_lists, variables_titles]
                     )
+                    if fragment is None:
+                        fragment = self._make_varstocases_table_syntax(table, variables_lists, variables_titles)
+                    yield table.id, fingerprint, fragment, None
+            else:
+                fingerprint, fragment = manifest.lookup('lin', table.id, self._get_table_inputs(table))
+                yield table.id, fingerprint, fragment, table if fragment is None else None
+
+    def _get_battery(self, split_id, hierarchical_structure, varstocases_tables_set):
+        """(first table, variables lists, subtitles) of questions of a VARSTOCASES group"""
+        variables_idxs = self.varstocases_vars[split_id]
+        tables = [varstocases_tables_set.get_table_by_id(hierarchical_structure[variable_idx]['variable_id'])
+                  for variable_idx in variables_idxs]
+        variables_lists = [hierarchical_structure[variable_idx]['variable_children'] for variable_idx in variables_idxs]
+        return tables[0], variables_lists, [table.subtitle for table in tables]
+
+    @profiled('upload_template')
+    def upload_template(self, path=None, incremental=False, processes=None, compress=False, shards=None,
+                        shard_by='tables', restructure_batch_size=None):
+        """Generates spss syntax files from the filled template.
+            Template rows are streamed through tables to syntax files, with compress=True files are gzipped.
+            With incremental=True syntax of tables and labels unchanged since the previous upload is reused,
+            all fragments are kept in memory and in the _sps.json manifest for that.
+            With processes > 1 tables are rendered in worker processes, the output stays the same.
+            With shards > 1 tables go to that many _lin_<n>.sps files balanced by tables count or estimated cost
+            to run in parallel, _lin.sps inserts them all.
+            With restructure_batch_size > 1 VARSTOCASES groups of the same shape are restructured by batches,
+            so the data file is restructured and reloaded once a batch instead of once a group"""
+        if not path:
+            path = self.template_file_path
 
-                    spss_syntax_file.write(u'\ngetbase.\n')
+        spss_syntax_file_path = os.path.splitext(path)[0] + "_lin.sps"
+        spss_lab_file_path = os.path.splitext(path)[0] + "_lab.sps"
+        manifest = SyntaxManifest(os.path.splitext(path)[0] + "_sps.json" if incremental else None)
+        hierarchical_structure = self._copy_hierarchical_structure()
+
+        from openpyxl import load_workbook
+
+        wb = load_workbook(filename=path, read_only=True)
+        try:
+            # values labels are read first, tables are rendered as soon as they are read
+            self._read_labels_sheet(wb['labels'], hierarchical_structure)
+            varstocases_tables_set = self._read_varstocases_tables(wb['tables'], hierarchical_structure)
+
+            restructure_batches = None
+            if restructure_batch_size and restructure_batch_size > 1:
+                restructure_batches = self._get_restructure_batches(restructure_batch_size)
+
+            jobs = self._iter_syntax_jobs(self._iter_tables(wb['tables'], hierarchical_structure),
+                                          hierarchical_structure, varstocases_tables_set, manifest,
+                                          restructure_batches=restructure_batches)
+            fragments = _iter_stored_fragments(render_tables_syntax(jobs, processes=processes), manifest)
+            if shards and shards > 1:
+                write_syntax_shards(spss_syntax_file_path, fragments, shards, shard_by=shard_by, compress=compress)
             else:
-                spss_syntax_file.write(table.to_syntax('spss'))
-
-        spss_syntax_file.close()
-
-        for question in self.hierarchical_structure:
-            for child in question['variable_children']:
-                if question['variable_label'] and question['variable_label'] != '':
-                    try:
-                        spss_lab_file.write(u'var lab {0} "{1}".\n'.format(
-                            child.replace(u'-', u''), question['variable_label'])
-                        )
-                    except UnicodeDecodeError:
-                        print(child)
-            if len(question['variable_values']):
-                spss_lab_file.write(u'val lab {0}\n'.format(
-                    u' '.join([child.replace(u'-', u'') for child in question['variable_children']]))
-                )
+                with open_syntax_file(spss_syntax_file_path, compress=compress) as spss_syntax_file:
+                    for fragment in fragments:
+                        spss_syntax_file.write(fragment)
+        finally:
+            wb.close()
+
+        with open_syntax_file(spss_lab_file_path, compress=compress) as spss_lab_file:
+            for question in hierarchical_structure:
+                spss_lab_file.write(manifest.get_fragment(
+                    'lab', question['variable_id'],
+                    inputs=[question['variable_children'], question['variable_label'],
+                            list(question['variable_values'].items())],
+                    render=lambda: self._make_labels_syntax(question)
+                ))
+
+        manifest.save()
+
+    def read_tables(self, path=None):
+        """Tables of the filled template with values labels of its labels sheet"""
+        if not path:
+            path = self.template_file_path
 
+        from openpyxl import load_workbook
+
+        hierarchical_structure = self._copy_hierarchical_structure()
+        wb = load_workbook(filename=path, read_only=True)
+        try:
+            self._read_labels_sheet(wb['labels'], hierarchical_structure)
+            return list(self._iter_tables(wb['tables'], hierarchical_structure))
+        finally:
+            wb.close()
+
+    @staticmethod
+    def _get_table_inputs(table):
+        return [table.id, table.title, table.subtitle, table.footer, table.corner, table.rows,
+                table.statistics.percentage.props, table.statistics.mean,
+                list(table.question_structure['variable_values'].keys())]
+
+    def _make_varstocases_table_syntax(self, table, variables_lists, variables_titles):
+        table.rows = variables_lists[0]
+
+        return self._make_varstocases_syntax(variables_lists=variables_lists, variables_titles=variables_titles) + \
+            table.to_syntax('spss').replace(u'tban', u'rot_idx by tban').replace(u'sban', u'sban rot_idx') + \
+            u'\ngetbase.\n'
+
+    def _make_varstocases_batch_syntax(self, batteries):
+        """One VARSTOCASES stacking all batteries, the tables of every battery follow its rot_idx labels
+            and are limited to cases of the battery, as if it were restructured alone"""
+        batch_syntax = [u'VARSTOCASES\n']
+        for _, variables_lists, _ in batteries:
+            for variables in zip(*variables_lists):
+                batch_syntax.append(u'/make ' + variables[0] + u' from ' + u' '.join(variables) + u'\n')
+        batch_syntax.append(u'/index rot_idx.\n\n')
+
+        for table, variables_lists, variables_titles in batteries:
+            profiler.count('restructured_batteries')
+            table.rows = variables_lists[0]
+            # rows with all variables of other batteries missing are dropped by VARSTOCASES of a battery alone
+            table.case_filter = u'nvalid(' + u', '.join(variables_lists[0]) + u') > 0'
+            batch_syntax.append(self._make_rot_idx_labels_syntax(variables_titles))
+            batch_syntax.append(
+                table.to_syntax('spss').replace(u'tban', u'rot_idx by tban').replace(u'sban', u'sban rot_idx')
+            )
+        batch_syntax.append(u'\ngetbase.\n')
+        return u''.join(batch_syntax)
+
+    @staticmethod
+    def _make_rot_idx_labels_syntax(variables_titles):
+        return u'val lab rot_idx\n' + \
+            u'\n'.join('%s "%s"' % (i+1, v.capitalize()) for i, v in enumerate(variables_titles) if v is not None) + \
+            u'.\n\n'
+
+    @staticmethod
+    def _make_labels_syntax(question):
+        labels_syntax = u''
+        for child in question['variable_children']:
+            if question['variable_label'] and question['variable_label'] != '':
                 try:
-                    spss_lab_file.write(u'{0}.\n'.format(
-                        u'\n'.join(
-                            [u'{k} "{v}"'.format(k=k, v=v) for k, v in question['variable_values'].items() if v]))
-                    )
+                    labels_syntax += u'var lab {0} "{1}".\n'.format(child.replace(u'-', u''), question['variable_label'])
                 except UnicodeDecodeError:
-                    print(question)
-                except TypeError:
-                    print(question)
+                    print(child)
+        if len(question['variable_values']):
+            labels_syntax += u'val lab {0}\n'.format(
+                u' '.join([child.replace(u'-', u'') for child in question['variable_children']])
+            )
 
-        spss_lab_file.close()
+            try:
+                labels_syntax += u'{0}.\n'.format(
+                    u'\n'.join([u'{k} "{v}"'.format(k=k, v=v) for k, v in question['variable_values'].items() if v])
+                )
+            except UnicodeDecodeError:
+                print(question)
+            except TypeError:
+                print(question)
+        return labels_syntax
 
-    def _make_varstocases_syntax(self, variables_idxs, tables_set):
+    @staticmethod
+    def _make_varstocases_syntax(variables_lists, variables_titles):
 
         varstocases_text = u''
 
-        variables_list = []
-        variables_titles = []
-        for variable_idx in variables_idxs:
-            variables_list.append(self.hierarchical_structure[variable_idx]['variable_children'])
-            variables_titles.append(
-                tables_set.get_table_by_id(
-                    self.hierarchical_structure[variable_idx]['variable_id']
-                ).subtitle
-            )
-
-        variables_joined = map(list, zip(*variables_list))
+        variables_joined = [list(variables) for variables in zip(*variables_lists)]
 
         varstocases_text += u'VARSTOCASES\n'
         for i_idx in range(len(variables_joined)):
                 varstocases_text += u'/make ' + variables_joined[i_idx][0] + u' from ' + u' '.join(variables_joined[i_idx]) + u'\n'
 
         varstocases_text += u'/index rot_idx.\n\n'
-        varstocases_text += u'val lab rot_idx\n'
-        varstocases_text += u'\n'.join('%s "%s"' % (i+1, v.capitalize()) for i, v in enumerate(variables_titles) if v is not None)
-        varstocases_text += u'.\n\n'
+        varstocases_text += TemplateMaker._make_rot_idx_labels_syntax(variables_titles)
 
         return varstocases_text
 
 
+def open_syntax_file(file_path, compress=False):
+    """Buffered utf-8 text file for syntax, with compress=True it is gzipped to file_path.gz"""
+    if compress:
+        return io.TextIOWrapper(gzip.open(file_path + '.gz', 'wb'), encoding='utf-8', errors='replace')
+    return io.open(file_path, mode='w', encoding='utf-8', errors='replace', buffering=SYNTAX_BUFFER_SIZE)
+
+
+def estimate_syntax_cost(fragment, shard_by='tables'):
+    """Tables of the syntax fragment, with shard_by='cost' a getbase after VARSTOCASES adds GETBASE_COST"""
+    cost = fragment.count(u'\nTABLES\n')
+    if shard_by == 'cost':
+        cost += GETBASE_COST * fragment.count(u'\ngetbase.\n')
+    return cost
+
+
+def split_into_shards(costs, shards):
+    """Splits items into at most shards runs of consecutive items of about equal total cost.
+        Returns the index of the first item of every run"""
+    total_cost = sum(costs)
+    starts = [0]
+    cost = 0
+    for item_idx, item_cost in enumerate(costs):
+        # an item starts the next run once the cost so far reaches the share of the runs before it
+        if item_idx and len(starts) < shards and cost >= total_cost * len(starts) / shards:
+            starts.append(item_idx)
+        cost += item_cost
+    return starts
+
+
+def write_syntax_shards(file_path, fragments, shards, shard_by='tables', compress=False):
+    """Writes fragments to shards files <file_path>_<n>.sps and file_path inserting them.
+        A fragment is never split, so a VARSTOCASES group stays in one shard with its getbase.
+        Shards are split once all costs are known, fragments wait in a temporary file meanwhile"""
+    costs = []
+    sizes = []
+    with tempfile.TemporaryFile() as spool_file:
+        for fragment in fragments:
+            costs.append(estimate_syntax_cost(fragment, shard_by))
+            data = fragment.encode('utf-8')
+            sizes.append(len(data))
+            spool_file.write(data)
+
+        starts = split_into_shards(costs, shards)
+        base_path = os.path.splitext(file_path)[0]
+        shards_paths = []
+        spool_file.seek(0)
+        for shard_idx, (start, end) in enumerate(zip(starts, starts[1:] + [len(sizes)])):
+            shard_path = '{0}_{1:02d}.sps'.format(base_path, shard_idx + 1)
+            with open_syntax_file(shard_path, compress=compress) as shard_file:
+                for size in sizes[start:end]:
+                    shard_file.write(spool_file.read(size).decode('utf-8'))
+            shards_paths.append(shard_path)
+    profiler.count('syntax_shards', len(shards_paths))
+
+    # compressed shards are inserted by the names they have once unpacked
+    with open_syntax_file(file_path, compress=compress) as master_file:
+        for shard_path in shards_paths:
+            master_file.write(u"INSERT FILE='{0}'.\n".format(os.path.abspath(shard_path)))
+    return shards_paths
+
+
+def _iter_stored_fragments(results, manifest):
+    """Fragments of render_tables_syntax results, stored in the manifest on the way"""
+    for table_id, fingerprint, fragment in results:
+        manifest.store('lin', table_id, fingerprint, fragment)
+        yield fragment
+
+
+def _render_syntax_job(job):
+    table_id, fingerprint, fragment, table = job
+    if fragment is None:
+        fragment = table.to_syntax('spss')
+    return table_id, fingerprint, fragment
+
+
+def render_tables_syntax(jobs, processes=None, chunksize=TABLES_CHUNK_SIZE):
+    """Renders (table id, fingerprint, fragment, table) jobs to (table id, fingerprint, fragment) keeping their
+        order. With processes > 1 tables are rendered in worker processes by batches of processes * chunksize jobs"""
+    jobs = iter(jobs)
+    batch = list(islice(jobs, processes * chunksize)) if processes and processes > 1 else []
+    if len(batch) <= chunksize:
+        for job in chain(batch, jobs):
+            yield _render_syntax_job(job)
+        return
+
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        while batch:
+            for result in pool.map(_render_syntax_job, batch, chunksize=chunksize):
+                yield result
+            batch = list(islice(jobs, processes * chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SyntaxManifest(object):
+    """Syntax fragments of the previous upload with fingerprints of the inputs they were made from.
+        Without manifest_file_path nothing is kept and every fragment is rendered"""
+
+    VERSION = 2
+
+    def __init__(self, manifest_file_path=None):
+        self.manifest_file_path = manifest_file_path
+        self.previous_fragments = {}
+        self.fragments = {}
+
+        if manifest_file_path and os.path.exists(manifest_file_path):
+            with codecs.open(manifest_file_path, mode='r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == self.VERSION:
+                self.previous_fragments = manifest['fragments']
+
+    def lookup(self, section, key, inputs):
+        """Returns fingerprint of inputs and the previous fragment if it was made from the same inputs or None"""
+        if not self.manifest_file_path:
+            return None, None
+        fingerprint = hashlib.sha1(json.dumps(inputs, default=repr).encode('utf-8')).hexdigest()
+        previous_fingerprint, fragment = self.previous_fragments.get(section, {}).get(key, (None, None))
+        if previous_fingerprint != fingerprint:
+            fragment = None
+        else:
+            profiler.count('reused_syntax_fragments')
+            self.store(section, key, fingerprint, fragment)
+        return fingerprint, fragment
+
+    def store(self, section, key, fingerprint, fragment):
+        if not self.manifest_file_path:
+            return
+        self.fragments.setdefault(section, {})[key] = (fingerprint, fragment)
+
+    def get_fragment(self, section, key, inputs, render):
+        fingerprint, fragment = self.lookup(section, key, inputs)
+        if fragment is None:
+            fragment = render()
+            self.store(section, key, fingerprint, fragment)
+        return fragment
+
+    def save(self):
+        if not self.manifest_file_path:
+            return
+        with codecs.open(self.manifest_file_path, mode='w', encoding='utf-8') as manifest_file:
+            manifest_file.write(json.dumps({'version': self.VERSION, 'fragments': self.fragments}, ensure_ascii=False))
+
+
 def create_template(sav_file_path, multiple_choice_separator='@',
-                    use_unlabeled_values=False, template_file_path=None):
+                    use_unlabeled_values=False, template_file_path=None, metadata_only=True, cache_dir=None,
+                    frequencies=False, sav_file_hash=None):
+    """sav_file_hash is get_file_hash of the sav file if the caller has it already"""
 
-    t1 = time.time()
     sav_file = SavFile(sav_file_name=sav_file_path,
+                       file_hash=sav_file_hash,
                        use_unlabeled_values=use_unlabeled_values,
-                       multiple_choice_separator=multiple_choice_separator)
-
-    print("sav file is readed for ", time.time() - t1, 'seconds')
+                       multiple_choice_separator=multiple_choice_separator,
+                       metadata_only=metadata_only,
+                       compact_struct=True,
+                       cache=SavCache(cache_dir) if cache_dir else None)
 
     if not template_file_path:
         template_file_path = sav_file_path + '.xlsx'
 
-    template = TemplateMaker(template_file_path=template_file_path, survey_structure=sav_file.plain_struct)
-
-    print("template initiated")
+    template = TemplateMaker(template_file_path=template_file_path, survey_structure=sav_file.plain_struct,
+                             sav_file_hash=sav_file.file_hash,
+                             value_frequencies=sav_file.get_value_frequencies() if frequencies else None)
 
     return template
 
 
 def download_xlsx_template(sav_file_path, multiple_choice_separator='@',
-                           use_unlabeled_values=False, template_file_path=None):
+                           use_unlabeled_values=False, template_file_path=None, metadata_only=True, cache_dir=None,
+                           frequencies=False):
 
     xlsx_template = create_template(sav_file_path=sav_file_path,
                                     multiple_choice_separator=multiple_choice_separator,
                                     use_unlabeled_values=use_unlabeled_values,
-                                    template_file_path=template_file_path)
+                                    template_file_path=template_file_path,
+                                    metadata_only=metadata_only,
+                                    cache_dir=cache_dir,
+                                    frequencies=frequencies)
 
     xlsx_template.download_template()
     print('template successfully created at ', xlsx_template.template_file_path)
 
 
 def upload_xlsx_templae(sav_file_path, multiple_choice_separator='@',
-                        use_unlabeled_values=False, template_file_path=None):
+                        use_unlabeled_values=False, template_file_path=None, metadata_only=True, processes=None,
+                        compress=False, cache_dir=None, shards=None, shard_by='tables', restructure_batch_size=None,
+                        incremental=False):
 
-    xlsx_template = create_template(sav_file_path=sav_file_path,
-                                    multiple_choice_separator=multiple_choice_separator,
-                                    use_unlabeled_values=use_unlabeled_values,
-                                    template_file_path=template_file_path)
+    if not template_file_path:
+        template_file_path = sav_file_path + '.xlsx'
 
-    xlsx_template.upload_template()
+    # the structure saved in the template is used while the sav file is unchanged
+    sav_file_hash = get_file_hash(sav_file_path)
+    xlsx_template = TemplateMaker.from_template(template_file_path=template_file_path,
+                                                sav_file_hash=sav_file_hash,
+                                                multiple_choice_separator=multiple_choice_separator)
+    if xlsx_template is None:
+        xlsx_template = create_template(sav_file_path=sav_file_path,
+                                        multiple_choice_separator=multiple_choice_separator,
+                                        use_unlabeled_values=use_unlabeled_values,
+                                        template_file_path=template_file_path,
+                                        metadata_only=metadata_only,
+                                        cache_dir=cache_dir,
+                                        sav_file_hash=sav_file_hash)
+
+    xlsx_template.upload_template(processes=processes, compress=compress, shards=shards, shard_by=shard_by,
+                                  restructure_batch_size=restructure_batch_size, incremental=incremental)
     print('spss files successfully created at ', xlsx_template.template_file_path)
 
 
-@click.command()
-@click.argument('action', type=click.Choice(choices=('upload', 'download')))
+def compute_xlsx_tables(sav_file_path, multiple_choice_separator='@', template_file_path=None,
+                        output_file_path=None, banner_variable=BANNER_VARIABLE, cache_dir=None):
+    """Computes tables of the filled template from case data of the sav file without spss.
+        Tables are written to output_file_path, as csv if it ends with .csv and as xlsx otherwise"""
+    from engine import TablesEngine, write_tables_csv, write_tables_xlsx
+
+    if not template_file_path:
+        template_file_path = sav_file_path + '.xlsx'
+    if not output_file_path:
+        output_file_path = os.path.splitext(template_file_path)[0] + '_tables.xlsx'
+
+    sav_file = SavFile(sav_file_name=sav_file_path,
+                       multiple_choice_separator=multiple_choice_separator,
+                       metadata_only=True,
+                       compact_struct=True,
+                       cache=SavCache(cache_dir) if cache_dir else None)
+    xlsx_template = TemplateMaker(template_file_path=template_file_path, survey_structure=sav_file.plain_struct)
+    results = TablesEngine(sav_file, banner_variable=banner_variable).compute(
+        xlsx_template.read_tables(), varstocases_tables_ids=xlsx_template.get_varstocases_tables_ids())
+
+    if output_file_path.lower().endswith('.csv'):
+        write_tables_csv(results, output_file_path)
+    else:
+        write_tables_xlsx(results, output_file_path)
+    print('tables successfully computed at ', output_file_path)
+
+
+def _run_batch_job(job):
+    # runs in a worker process, errors are returned so that one file does not abort the batch
+    action, sav_file_path, xlsx_file_path, multiple_choice_separator = job
+    t1 = time.time()
+    try:
+        if action == 'download':
+            download_xlsx_template(sav_file_path=sav_file_path,
+                                   multiple_choice_separator=multiple_choice_separator,
+                                   template_file_path=xlsx_file_path)
+        else:
+            upload_xlsx_templae(sav_file_path=sav_file_path,
+                                multiple_choice_separator=multiple_choice_separator,
+                                template_file_path=xlsx_file_path)
+    except Exception:
+        return sav_file_path, time.time() - t1, traceback.format_exc()
+    return sav_file_path, time.time() - t1, None
+
+
+def _read_batch_manifest(manifest_path):
+    # csv lines: sav file path[,xlsx template file path]
+    with codecs.open(manifest_path, mode='r', encoding='utf-8') as manifest_file:
+        for line in csv.reader(manifest_file):
+            if not line or not line[0].strip() or line[0].startswith('#'):
+                continue
+            yield line[0].strip(), line[1].strip() if len(line) > 1 and line[1].strip() else None
+
+
+@click.group()
+@click.option('--profile', help='write json report of stages timings, counts and peak memory to the path',
+              type=click.Path(writable=True, file_okay=True))
+@click.option('--cprofile', help='write cProfile stats to the path', type=click.Path(writable=True, file_okay=True))
+@click.pass_context
+def cli(ctx, profile, cprofile):
+    # worker processes of batch are not profiled
+    if profile:
+        profiler.enabled = True
+        ctx.call_on_close(lambda: profiler.save(profile))
+    if cprofile:
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+        def _dump_cprofile_stats():
+            cprofiler.disable()
+            cprofiler.dump_stats(cprofile)
+        ctx.call_on_close(_dump_cprofile_stats)
+
+
+@cli.command(name='download')
 @click.argument('sav_file_path', type=click.Path(exists=True, readable=True, file_okay=True))
 @click.option('--multiple-choice-separator', help='multiple choice separator', default='@', type=str)
 @click.option('--xlsx-file-path', help='excel template file path', type=click.Path(writable=True, file_okay=True))
-def handle_commands(action, sav_file_path, multiple_choice_separator, xlsx_file_path):
-
-    if action == 'download':
-        download_xlsx_template(
-            sav_file_path=sav_file_path,
-            multiple_choice_separator=multiple_choice_separator,
-            template_file_path=xlsx_file_path
-        )
-    if action == 'upload':
-        if xlsx_file_path is None:
-            print('please specify xlsx template file path --xlsx-file-path')
-            exit()
-        upload_xlsx_templae(
-            sav_file_path=sav_file_path,
-            multiple_choice_separator=multiple_choice_separator,
-            template_file_path=xlsx_file_path
-        )
+@click.option('--cache', help='keep decoded sav file in the cache directory for later runs', is_flag=True)
+@click.option('--cache-dir', help='cache directory', default=DEFAULT_CACHE_DIR, show_default=True,
+              type=click.Path(file_okay=False))
+@click.option('--frequencies', help='add counts of values in case data to the template', is_flag=True)
+def download_command(sav_file_path, multiple_choice_separator, xlsx_file_path, cache, cache_dir, frequencies):
+    download_xlsx_template(
+        sav_file_path=sav_file_path,
+        multiple_choice_separator=multiple_choice_separator,
+        template_file_path=xlsx_file_path,
+        cache_dir=cache_dir if cache else None,
+        frequencies=frequencies
+    )
+
+
+@cli.command(name='upload')
+@click.argument('sav_file_path', type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', help='multiple choice separator', default='@', type=str)
+@click.option('--xlsx-file-path', help='excel template file path', type=click.Path(writable=True, file_okay=True))
+@click.option('--processes', help='number of worker processes rendering tables', type=int)
+@click.option('--compress', help='gzip spss files', is_flag=True)
+@click.option('--cache', help='keep decoded sav file in the cache directory for later runs', is_flag=True)
+@click.option('--cache-dir', help='cache directory', default=DEFAULT_CACHE_DIR, show_default=True,
+              type=click.Path(file_okay=False))
+@click.option('--shards', help='number of tables syntax files to run in parallel', type=int)
+@click.option('--shard-by', help='balance shards by tables count or by estimated cost', default='tables',
+              show_default=True, type=click.Choice(choices=('tables', 'cost')))
+@click.option('--batch-restructures', help='restructure grids of the same size by one VARSTOCASES', is_flag=True)
+@click.option('--restructure-batch-size', help='grids restructured at once', default=RESTRUCTURE_BATCH_SIZE,
+              show_default=True, type=int)
+@click.option('--incremental', help='reuse syntax of tables unchanged since the previous upload', is_flag=True)
+def upload_command(sav_file_path, multiple_choice_separator, xlsx_file_path, processes, compress, cache,
+                   cache_dir, shards, shard_by, batch_restructures, restructure_batch_size, incremental):
+    if xlsx_file_path is None:
+        print('please specify xlsx template file path --xlsx-file-path')
+        exit()
+    upload_xlsx_templae(
+        sav_file_path=sav_file_path,
+        multiple_choice_separator=multiple_choice_separator,
+        template_file_path=xlsx_file_path,
+        processes=processes,
+        compress=compress,
+        cache_dir=cache_dir if cache else None,
+        shards=shards,
+        shard_by=shard_by,
+        restructure_batch_size=restructure_batch_size if batch_restructures else None,
+        incremental=incremental
+    )
+
+
+@cli.command(name='compute')
+@click.argument('sav_file_path', type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', help='multiple choice separator', default='@', type=str)
+@click.option('--xlsx-file-path', help='excel template file path', type=click.Path(exists=True, file_okay=True))
+@click.option('--output-file-path', help='tables file path, .xlsx or .csv',
+              type=click.Path(writable=True, file_okay=True))
+@click.option('--banner-variable', help='variable tables are broken down by', default=BANNER_VARIABLE,
+              show_default=True)
+@click.option('--cache', help='keep decoded sav file in the cache directory for later runs', is_flag=True)
+@click.option('--cache-dir', help='cache directory', default=DEFAULT_CACHE_DIR, show_default=True,
+              type=click.Path(file_okay=False))
+def compute_command(sav_file_path, multiple_choice_separator, xlsx_file_path, output_file_path, banner_variable,
+                    cache, cache_dir):
+    """Computes tables of the template from the sav file without spss"""
+    compute_xlsx_tables(
+        sav_file_path=sav_file_path,
+        multiple_choice_separator=multiple_choice_separator,
+        template_file_path=xlsx_file_path,
+        output_file_path=output_file_path,
+        banner_variable=banner_variable,
+        cache_dir=cache_dir if cache else None
+    )
+
+
+@cli.command(name='batch')
+@click.argument('action', type=click.Choice(choices=('upload', 'download')))
+@click.argument('sav_file_patterns', nargs=-1)
+@click.option('--manifest', help='csv file with sav file path and xlsx template file path on each line',
+              type=click.Path(exists=True, readable=True, file_okay=True))
+@click.option('--multiple-choice-separator', help='multiple choice separator', default='@', type=str)
+@click.option('--processes', help='number of worker processes, cpu count by default', type=int)
+def batch_command(action, sav_file_patterns, manifest, multiple_choice_separator, processes):
+    """Downloads or uploads templates of many sav files in parallel.
+        Templates of sav files given by glob patterns are expected at <sav file path>.xlsx"""
+    jobs = []
+    for sav_file_pattern in sav_file_patterns:
+        for sav_file_path in sorted(glob.glob(sav_file_pattern)):
+            jobs.append((action, sav_file_path, None, multiple_choice_separator))
+    if manifest:
+        for sav_file_path, xlsx_file_path in _read_batch_manifest(manifest):
+            jobs.append((action, sav_file_path, xlsx_file_path, multiple_choice_separator))
+    if not jobs:
+        print('no sav files found')
+        exit(1)
+
+    failed = []
+    t1 = time.time()
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        for sav_file_path, elapsed, error in pool.imap_unordered(_run_batch_job, jobs):
+            print('{0} {1} for {2:.2f} seconds'.format(sav_file_path, 'failed' if error else 'done', elapsed))
+            if error:
+                failed.append((sav_file_path, error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print('{0} of {1} files done for {2:.2f} seconds'.format(len(jobs) - len(failed), len(jobs), time.time() - t1))
+    for sav_file_path, error in failed:
+        print('\n' + sav_file_path + '\n' + error)
+    if failed:
+        exit(1)
 
 
 if __name__ == '__main__':
-    handle_commands()
+    cli()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import os
+
+import pandas as pd
+import pytest
+
+from cache import SavCache
+from parsers import SavFile
+
+try:
+    import savReaderWriter
+except ImportError:
+    # it does not import on python 3.10+
+    pytest.skip('savReaderWriter is not importable', allow_module_level=True)
+
+
+def test_cached_data(tmpdir):
+    sav_file_path = str(tmpdir.join('survey.sav'))
+    # labels are shared by the children of a question, strings are padded to 16 bytes in the file
+    with savReaderWriter.SavWriter(sav_file_path, ['q@1', 'q@2', 'txt'], {'q@1': 0, 'q@2': 0, 'txt': 16},
+                                   varLabels={'q@1': 'Question', 'q@2': 'Question', 'txt': 'Open'},
+                                   ioUtf8=True) as writer:
+        for case_idx in range(25):
+            writer.writerow([None if case_idx % 4 == 0 else case_idx % 3, case_idx % 2,
+                             'ответ %d' % case_idx if case_idx % 2 else ''])
+
+    cache = SavCache(str(tmpdir.join('cache')))
+    written_data = SavFile(sav_file_name=sav_file_path, cache=cache).data
+    assert len(os.listdir(cache.cache_dir)) == 1
+    cached_data = SavFile(sav_file_name=sav_file_path, cache=cache).data
+    data = SavFile(sav_file_name=sav_file_path).data
+
+    assert data['txt'].tolist()[:2] == ['', 'ответ 1']
+    pd.testing.assert_frame_equal(written_data, data)
+    pd.testing.assert_frame_equal(cached_data, data)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import csv
+import io
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine import TablesEngine
+from models import Table, TableStatistics
+from parsers import SavFile
+from template import compute_xlsx_tables, download_xlsx_template
+
+try:
+    import savReaderWriter
+except ImportError:
+    # it does not import on python 3.10+
+    savReaderWriter = None
+
+NAN = np.nan
+
+
+class StubSavFile(object):
+    """Case data and metadata of SavFile used by TablesEngine"""
+
+    def __init__(self):
+        self.cases = pd.DataFrame({
+            'q1': [1, 2, 9, 1, NAN, 2],
+            'q2a': [1, 1, NAN, 2, 3, NAN],
+            'q2b': [2, 1, NAN, NAN, 1, NAN],
+            'txt': ['a'] * 6,
+            'tban': [1, 1, 1, 2, 2, NAN],
+        })
+
+    def _get_variable_types(self):
+        return {'q1': 0, 'q2a': 0, 'q2b': 0, 'txt': 3, 'tban': 0}
+
+    def _get_value_labels(self):
+        return {'tban': {1.0: 'men', 2.0: 'women'}}
+
+    def iter_cases(self, chunk_size, variables):
+        for chunk_start in range(0, len(self.cases), chunk_size):
+            yield self.cases[variables][chunk_start:chunk_start + chunk_size]
+
+
+def _make_table(table_id, rows, variable_values, properties):
+    table = Table(question_structure={'variable_id': table_id, 'variable_values': variable_values})
+    table.id = table_id
+    table.title = table_id
+    table.subtitle = ''
+    table.footer = ''
+    table.corner = ''
+    table.rows = rows
+    table.statistics = TableStatistics()
+    table.statistics.add_properties(properties)
+    return table
+
+
+def _compute(chunk_size, varstocases_tables_ids=()):
+    tables = [
+        _make_table('q1', ['q1'], {1: 'a', 2: 'b', 9: 'dk'}, 't1 b1 m'),
+        _make_table('q2', ['q2a', 'q2b'], {1.0: 'x', 2.0: 'y'}, None),
+        _make_table('txt', ['txt'], {}, None),
+    ]
+    results = TablesEngine(StubSavFile(), chunk_size=chunk_size).compute(
+        tables, varstocases_tables_ids=varstocases_tables_ids)
+    return results, dict(((result.table.id, label, statistic), values)
+                         for result in results for label, statistic, values in result.rows)
+
+
+def _assert_values(values, expected_values):
+    assert len(values) == len(expected_values)
+    for value, expected_value in zip(values, expected_values):
+        if expected_value is None:
+            assert value is None
+        else:
+            assert value == pytest.approx(expected_value)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 1000])
+def test_compute(chunk_size):
+    results, rows = _compute(chunk_size)
+
+    # string variables are not tabulated
+    assert [result.table.id for result in results] == ['q1', 'q2']
+    assert results[0].columns == ['Total', 'men', 'women']
+
+    # 9 is counted, but left out of mean and variance; the cases missing q1 or tban are not in the table
+    _assert_values(rows['q1', 'a', 'count'], [2, 1, 1])
+    _assert_values(rows['q1', 'a', 'cpct'], [50, 100 / 3, 100])
+    _assert_values(rows['q1', 'b', 'count'], [1, 1, 0])
+    _assert_values(rows['q1', 'dk', 'count'], [1, 1, 0])
+    _assert_values(rows['q1', 'Top-1', 'count'], [1, 1, 0])
+    _assert_values(rows['q1', 'Bottom-1', 'count'], [2, 1, 1])
+    _assert_values(rows['q1', 'mean', 'mean'], [4 / 3, 1.5, 1.0])
+    _assert_values(rows['q1', 'variance', 'variance'], [1 / 3, 0.5, None])
+    _assert_values(rows['q1', 'BASE', 'base'], [4, 3, 1])
+
+    # a case is counted once per value of any row, unlabeled values follow labeled ones
+    _assert_values(rows['q2', 'x', 'count'], [3, 2, 1])
+    _assert_values(rows['q2', 'y', 'count'], [2, 1, 1])
+    _assert_values(rows['q2', '3', 'count'], [1, 0, 1])
+    _assert_values(rows['q2', 'x', 'cpct'], [75, 100, 50])
+    _assert_values(rows['q2', 'BASE', 'base'], [5, 3, 2])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1000])
+def test_compute_varstocases_tables(chunk_size):
+    _, rows = _compute(chunk_size, varstocases_tables_ids={'q2'})
+
+    # cases missing all rows are dropped by VARSTOCASES, counts do not change
+    _assert_values(rows['q2', 'x', 'count'], [3, 2, 1])
+    _assert_values(rows['q2', 'x', 'cpct'], [75, 100, 50])
+    _assert_values(rows['q2', 'BASE', 'base'], [4, 2, 2])
+    _assert_values(rows['q1', 'BASE', 'base'], [4, 3, 1])
+
+
+@pytest.mark.skipif(savReaderWriter is None, reason='savReaderWriter is not importable')
+def test_compute_xlsx_tables(tmpdir):
+    sav_file_path = str(tmpdir.join('survey.sav'))
+    variables_names = ['q@1', 'q@2', 'q@3', 'tban']
+    values_labels = {1: 'a', 2: 'b', 3: 'c'}
+    random_generator = random.Random(0)
+    # choices of the multiple choice question share its label
+    with savReaderWriter.SavWriter(sav_file_path, variables_names, dict.fromkeys(variables_names, 0),
+                                   varLabels={'q@1': 'Which', 'q@2': 'Which', 'q@3': 'Which', 'tban': 'Gender'},
+                                   valueLabels={'q@1': values_labels, 'q@2': values_labels, 'q@3': values_labels,
+                                                'tban': {1: 'men', 2: 'women'}},
+                                   ioUtf8=True) as writer:
+        for _ in range(200):
+            writer.writerow([random_generator.choice([1, 2, 3, None]) for _ in range(3)] +
+                            [random_generator.choice([1, 2, None])])
+    xlsx_file_path = str(tmpdir.join('survey.xlsx'))
+    csv_file_path = str(tmpdir.join('tables.csv'))
+    download_xlsx_template(sav_file_path, template_file_path=xlsx_file_path)
+    compute_xlsx_tables(sav_file_path, template_file_path=xlsx_file_path, output_file_path=csv_file_path)
+
+    with io.open(csv_file_path, encoding='utf-8', newline='') as csv_file:
+        values = dict(((table_id, row, statistic, column), float(value))
+                      for table_id, row, statistic, column, value in list(csv.reader(csv_file))[1:] if value)
+
+    # cases missing tban are left out, a case is counted once per chosen value
+    data = SavFile(sav_file_name=sav_file_path).data
+    data = data[data['tban'].notnull()]
+    choices = data[['q@1', 'q@2', 'q@3']]
+    for value, label in values_labels.items():
+        is_chosen = (choices == value).any(axis=1)
+        assert values['q', label, 'count', 'Total'] == is_chosen.sum()
+        assert values['q', label, 'count', 'men'] == (is_chosen & (data['tban'] == 1)).sum()
+        assert values['q', label, 'count', 'women'] == (is_chosen & (data['tban'] == 2)).sum()
+    assert values['q', 'BASE', 'base', 'Total'] == len(data)
+    assert values['q', 'BASE', 'base', 'women'] == (data['tban'] == 2).sum()
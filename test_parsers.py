@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import numpy as np
+import pytest
+
+from parsers import SavFile
+
+try:
+    import savReaderWriter
+except ImportError:
+    # it does not import on python 3.10+
+    pytest.skip('savReaderWriter is not importable', allow_module_level=True)
+
+
+def _write_sav_file(sav_file_path, cases_count=25):
+    # children of the multiple choice question and the open answer share the question label
+    with savReaderWriter.SavWriter(sav_file_path, [b'q@1', b'q@2', b'txt'], {b'q@1': 0, b'q@2': 0, b'txt': 8},
+                                   varLabels={b'q@1': b'Question', b'q@2': b'Question', b'txt': b'Question'},
+                                   valueLabels={b'q@1': {1: b'yes'}, b'q@2': {1: b'yes'}}) as writer:
+        for case_idx in range(cases_count):
+            writer.writerow([None if case_idx % 4 == 0 else case_idx % 3, case_idx % 2,
+                             b'abc' if case_idx % 2 else b''])
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_iter_cases_shared_labels(tmpdir, memmap):
+    sav_file_path = str(tmpdir.join('shared_labels.sav'))
+    _write_sav_file(sav_file_path)
+    sav_file = SavFile(sav_file_name=sav_file_path, metadata_only=True)
+
+    chunks = list(sav_file.iter_cases(chunk_size=7, as_dataframe=False,
+                                      memmap_file_name=str(tmpdir.join('cases.dat')) if memmap else None))
+    cases = np.concatenate(chunks)
+
+    assert [len(chunk) for chunk in chunks] == [7, 7, 7, 4]
+    assert cases.dtype.names == ('q@1', 'q@2', 'txt')
+    # system missing values are nan and strings are not padded, as in SavFile.data
+    assert np.isnan(cases['q@1']).sum() == 7
+    assert cases['txt'].tolist() == [b'abc' if case_idx % 2 else b'' for case_idx in range(25)]
+    assert cases['q@2'].tolist() == sav_file.data['q@2'].tolist()
+
+
+def test_get_value_frequencies(tmpdir):
+    sav_file_path = str(tmpdir.join('shared_labels.sav'))
+    _write_sav_file(sav_file_path, cases_count=100)
+    sav_file = SavFile(sav_file_name=sav_file_path, metadata_only=True)
+
+    # small chunks, so counts are merged over chunks
+    frequencies = sav_file.get_value_frequencies(chunk_cells=30)
+    open_frequencies = sav_file.get_value_frequencies(max_distinct_values=2, chunk_cells=30)
+
+    # string variables are not counted, neither are system missing values
+    assert list(frequencies) == ['q@1', 'q@2']
+    for variable_id, value_frequencies in frequencies.items():
+        assert value_frequencies == sav_file.data[variable_id].value_counts().sort_index().to_dict()
+    assert frequencies['q@1'] == {0.0: 25, 1.0: 25, 2.0: 25}
+    # q@1 has three distinct values, more than max_distinct_values
+    assert list(open_frequencies) == ['q@2']
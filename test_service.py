@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import threading
+
+import pytest
+
+from service import HTTPServer, ServiceRequestHandler, TemplateMakersCache, call_service, serve
+
+
+@pytest.fixture
+def server_port():
+    server = HTTPServer(('127.0.0.1', 0), ServiceRequestHandler)
+    server.template_makers = TemplateMakersCache()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.mark.parametrize('request_body', [
+    [],
+    {},
+    {'sav_file_path': 1},
+    {'sav_file_path': ['survey.sav']},
+    {'sav_file_path': __file__, 'processes': '2'},
+    {'sav_file_path': __file__, 'processes': True},
+    {'sav_file_path': __file__, 'xlsx_file_path': {}},
+    {'sav_file_path': 'missing.sav'},
+])
+def test_invalid_requests(server_port, request_body):
+    code, response = call_service('/upload', request_body, port=server_port)
+
+    assert code == 400
+    assert response['error']
+    assert call_service('/status', port=server_port) == (200, TemplateMakersCache().status())
+
+
+def test_serve_loopback_only():
+    with pytest.raises(ValueError):
+        serve(host='0.0.0.0')
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import pickle
+
+import pytest
+
+from structs import CompactSurveyStructure, SurveyStructure
+
+
+def _make_survey_structure(struct_class):
+    survey_structure = struct_class(multiple_choice_separator='@')
+    for question_idx in range(3):
+        for child in range(1, 4):
+            survey_structure.add_variable('q%d@%d' % (question_idx, child), 0, 'Question %d' % question_idx,
+                                          variable_values={1.0: 'yes', 2.0: 'no'})
+    survey_structure.add_variable('open', 1, 'Open')
+    return survey_structure
+
+
+def test_compact_survey_structure():
+    survey_structure = _make_survey_structure(SurveyStructure)
+    compact_survey_structure = _make_survey_structure(CompactSurveyStructure)
+
+    assert len(compact_survey_structure) == len(survey_structure)
+    for compact_variable, variable in zip(compact_survey_structure, survey_structure):
+        assert dict(compact_variable, variable_children=list(compact_variable['variable_children'])) == variable
+    assert compact_survey_structure.convert_to_hierarchical_structure() == \
+        survey_structure.convert_to_hierarchical_structure()
+
+    compact_survey_structure.remove('q1@2')
+    compact_survey_structure.add_variable('open', 1, 'Open answer')
+    assert compact_survey_structure.get_all_questions_ids() == \
+        ['q0@1', 'q0@2', 'q0@3', 'q1@1', 'q1@3', 'q2@1', 'q2@2', 'q2@3', 'open']
+    assert compact_survey_structure.get_variable_by_id('open')['variable_label'] == 'Open answer'
+
+
+def test_compact_survey_structure_is_read_only():
+    compact_survey_structure = _make_survey_structure(CompactSurveyStructure)
+    variable = compact_survey_structure.get_variable_by_id('q0@1')
+
+    # items are built on access, changes would be lost
+    with pytest.raises(TypeError):
+        variable['variable_label'] = 'Changed'
+    with pytest.raises(TypeError):
+        variable['variable_values'][3.0] = 'maybe'
+    with pytest.raises(TypeError):
+        variable['variable_values'].update({3.0: 'maybe'})
+    with pytest.raises(TypeError):
+        variable.pop('variable_label')
+    assert compact_survey_structure.get_variable_by_id('q0@1')['variable_label'] == 'Question 0'
+
+    # copies are detached, so they can be changed
+    variable_copy = pickle.loads(pickle.dumps(variable))
+    variable_copy['variable_label'] = 'Changed'
+    variable_copy['variable_values'][3.0] = 'maybe'
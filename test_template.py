@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division, unicode_literals
+
+import os
+import shutil
+from collections import OrderedDict
+
+from openpyxl import load_workbook
+
+from models import Table, TableStatistics
+from structs import SurveyStructure, VariableStructure
+from template import STRUCTURE_SHEET, TemplateMaker, TABLES_CHUNK_SIZE, render_tables_syntax
+
+VARIABLE_VALUES = OrderedDict([(1.0, 'yes'), (2.0, 'no'), (9.0, 'dk')])
+
+
+def _make_jobs(tables_count):
+    jobs = []
+    for idx in range(tables_count):
+        table = Table(question_structure=VariableStructure(variable_id='q%d' % idx, variable_type=0,
+                                                           variable_values=VARIABLE_VALUES))
+        table.id = 'q%d' % idx
+        table.title = 'Title %d' % idx
+        table.subtitle = 'Question %d' % idx
+        table.footer = 'Base: all respondents'
+        table.corner = ''
+        table.rows = ['q%d@%d' % (idx, child) for child in range(3)]
+        table.statistics = TableStatistics()
+        table.statistics.add_properties(('t1 b1 m', 'm', '', 't2')[idx % 4])
+        jobs.append((table.id, None, None, table))
+    return jobs
+
+
+def _make_survey_structure(questions_count):
+    # pairs of questions q<n>_0 and q<n>_1 are the batteries of VARSTOCASES groups
+    survey_structure = SurveyStructure(multiple_choice_separator='@')
+    for question_idx in range(questions_count):
+        for child in range(3):
+            survey_structure.add_variable('q%d_%d@%d' % (question_idx // 2, question_idx % 2, child), 0,
+                                          'Question %d' % question_idx, variable_values=VARIABLE_VALUES)
+    survey_structure.add_variable('open', 1, 'Open')
+    return survey_structure
+
+
+def test_render_tables_syntax_in_processes():
+    jobs = _make_jobs(3000)
+
+    serial_fragments = list(render_tables_syntax(jobs))
+    pool_fragments = list(render_tables_syntax(jobs, processes=4, chunksize=50))
+
+    assert len(serial_fragments) == len(jobs)
+    assert pool_fragments == serial_fragments
+
+
+def test_upload_template_in_processes(tmpdir):
+    # a table per VARSTOCASES group and the open question, more tables than a chunk for the worker processes
+    tables_count = TABLES_CHUNK_SIZE + 100
+    template_maker = TemplateMaker(template_file_path=str(tmpdir.join('serial.xlsx')),
+                                   survey_structure=_make_survey_structure(2 * (tables_count - 1)),
+                                   treat_as_independent_vars=['open'])
+    template_maker.download_template()
+    shutil.copy(str(tmpdir.join('serial.xlsx')), str(tmpdir.join('pool.xlsx')))
+
+    template_maker.upload_template(path=str(tmpdir.join('serial.xlsx')), incremental=False)
+    template_maker.upload_template(path=str(tmpdir.join('pool.xlsx')), incremental=False, processes=2)
+
+    with open(str(tmpdir.join('serial_lin.sps')), 'rb') as serial_file:
+        serial_syntax = serial_file.read()
+    with open(str(tmpdir.join('pool_lin.sps')), 'rb') as pool_file:
+        pool_syntax = pool_file.read()
+    assert serial_syntax.count(b'\nTABLES\n') == tables_count
+    assert pool_syntax == serial_syntax
+    assert os.path.getsize(str(tmpdir.join('pool_lab.sps')))
+
+
+def test_from_template(tmpdir):
+    template_file_path = str(tmpdir.join('survey.xlsx'))
+    TemplateMaker(template_file_path=template_file_path, survey_structure=_make_survey_structure(4),
+                  sav_file_hash='hash').download_template()
+
+    restored = TemplateMaker.from_template(template_file_path, sav_file_hash='hash', multiple_choice_separator='@')
+    assert [variable_structure['variable_id'] for variable_structure in restored.plain_structure] == \
+        [variable_structure['variable_id'] for variable_structure in _make_survey_structure(4)]
+    assert TemplateMaker.from_template(template_file_path, sav_file_hash='other', multiple_choice_separator='@') \
+        is None
+
+    # an emptied structure sheet falls back to reading the sav file
+    wb = load_workbook(filename=template_file_path)
+    wb.remove(wb[STRUCTURE_SHEET])
+    wb.create_sheet(title=STRUCTURE_SHEET)
+    wb.save(template_file_path)
+    assert TemplateMaker.from_template(template_file_path, sav_file_hash='hash', multiple_choice_separator='@') \
+        is None
+
+
+def test_upload_template_incremental(tmpdir):
+    template_file_path = str(tmpdir.join('survey.xlsx'))
+    template_maker = TemplateMaker(template_file_path=template_file_path,
+                                   survey_structure=_make_survey_structure(6), treat_as_independent_vars=['open'])
+    template_maker.download_template()
+
+    # the manifest is only written on request
+    template_maker.upload_template()
+    with open(str(tmpdir.join('survey_lin.sps')), 'rb') as syntax_file:
+        syntax = syntax_file.read()
+    assert not os.path.exists(str(tmpdir.join('survey_sps.json')))
+
+    template_maker.upload_template(incremental=True)
+    template_maker.upload_template(incremental=True)
+    assert os.path.exists(str(tmpdir.join('survey_sps.json')))
+    with open(str(tmpdir.join('survey_lin.sps')), 'rb') as syntax_file:
+        assert syntax_file.read() == syntax
+
+
+def test_upload_template_in_shards(tmpdir):
+    template_file_path = str(tmpdir.join('survey.xlsx'))
+    template_maker = TemplateMaker(template_file_path=template_file_path,
+                                   survey_structure=_make_survey_structure(40), treat_as_independent_vars=['open'])
+    template_maker.download_template()
+    template_maker.upload_template()
+    with open(str(tmpdir.join('survey_lin.sps')), 'rb') as syntax_file:
+        syntax = syntax_file.read()
+
+    template_maker.upload_template(shards=3, shard_by='cost')
+
+    shards_syntax = b''
+    for shard_idx in range(1, 4):
+        with open(str(tmpdir.join('survey_lin_%02d.sps' % shard_idx)), 'rb') as shard_file:
+            shard_syntax = shard_file.read()
+        assert shard_syntax.count(b'\nTABLES\n')
+        shards_syntax += shard_syntax
+    assert shards_syntax == syntax